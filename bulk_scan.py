@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+'''Scan whole directories of hexameter TEI files in parallel, resumably.
+
+Files are scanned by a pool of worker processes, each writing its output
+beside the input as ``scan.py`` does. Progress is kept in a checkpoint
+directory: each book's analyses are saved as soon as it is finished, and
+each file is recorded once its output is written. If a run is interrupted,
+running it again with the same checkpoint directory skips finished files
+and reuses finished books of the rest. A file that has changed since its
+checkpoint, or whose output is missing, is scanned again from the start,
+as is every file if the lexicon, budget, works manifest or scanner code
+differ from the run that wrote the checkpoint.
+
+Works other than the Iliad and Odyssey are identified from a manifest
+(``--works``): a JSON list of objects with each work's ``name`` and
+``abbrev``, and optionally the ``title`` text identifying it in the TEI
+header and the ``division`` type of its books (see ``tei.load_works``).
+'''
+
+import hashlib
+import json
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import Manager
+from xml.etree import ElementTree
+
+import hexameter
+import scan
+import tei
+
+CHECKPOINT_DIR = 'scan-checkpoint'
+
+def find_tei_files(paths):
+    '''List the TEI files to scan: files named directly, and unscanned
+    ``.xml`` files anywhere under directories.'''
+    fnames = []
+    for path in paths:
+        if not os.path.isdir(path):
+            fnames.append(path)
+            continue
+        for dirpath, dirnames, filenames in os.walk(path):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.endswith('.xml') and not name.endswith('.scanned.xml'):
+                    fnames.append(os.path.join(dirpath, name))
+    return fnames
+
+def _source_key(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime]
+
+def _write_json(fname, data):
+    # write atomically so an interruption never leaves a partial file
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as outf:
+        json.dump(data, outf, ensure_ascii=False)
+    os.replace(tmp_fname, fname)
+
+def _read_json(fname):
+    try:
+        with open(fname) as inf:
+            return json.load(inf)
+    except (OSError, ValueError):
+        return None
+
+def _file_digest(fname):
+    with open(fname, 'rb') as inf:
+        return hashlib.sha1(inf.read()).hexdigest()
+
+def job_fingerprint(works=None, lexicon_fname=None, budget=None):
+    '''Identify everything besides the input files that a scan depends on:
+    the works manifest, the lexicon, the budget, and the scanner's source
+    code. Checkpoints written under a different fingerprint are stale.'''
+    job = {
+        'works': [list(work) for work in works] if works else None,
+        'lexicon': _file_digest(lexicon_fname) if lexicon_fname else None,
+        'budget': vars(budget) if budget is not None else None,
+        'code': [_file_digest(module.__file__)
+                 for module in (hexameter, scan, tei)],
+    }
+    content = json.dumps(job, sort_keys=True)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+###
+### checkpoints
+###
+
+class BookCheckpoints:
+    '''Analyses of the finished books of one file.'''
+    def __init__(self, directory, fname, job=None):
+        path = os.path.abspath(fname)
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()[:10]
+        self.prefix = os.path.join(
+            directory, '%s.%s' % (os.path.basename(fname), digest))
+        self.source = _source_key(fname)
+        self.job = job
+
+    def _book_fname(self, book_num):
+        return '%s.book-%s.json' % (self.prefix, book_num)
+
+    def load(self, book_num):
+        '''A finished book, or None if it hasn't been checkpointed.
+
+        :rtype: dict of ``lines``, the analyses of each line in order, and
+            ``lexicon_decided``, the quantities decided by the lexicon
+        '''
+        saved = _read_json(self._book_fname(book_num))
+        if (saved is None or saved['source'] != self.source or
+                saved.get('job') != self.job):
+            return None
+        saved.setdefault('lexicon_decided', 0)
+        return saved
+
+    def save(self, book_num, lines, lexicon_decided):
+        _write_json(self._book_fname(book_num),
+                    {'source': self.source, 'job': self.job, 'lines': lines,
+                     'lexicon_decided': lexicon_decided})
+
+    def clear(self):
+        directory = os.path.dirname(self.prefix)
+        base = os.path.basename(self.prefix) + '.book-'
+        for name in os.listdir(directory):
+            if name.startswith(base):
+                os.remove(os.path.join(directory, name))
+
+class Checkpoint:
+    '''Files finished by a bulk job, with their stats.
+
+    :param job: fingerprint of the job, from :func:`job_fingerprint`
+    '''
+    def __init__(self, directory, job=None):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.job = job
+        self.fname = os.path.join(directory, 'progress.json')
+        self.files = _read_json(self.fname) or {}
+
+    def finished(self, fname):
+        '''The stats of a file if it was finished by the same job, hasn't
+        changed since, and its output still exists, otherwise None.'''
+        entry = self.files.get(os.path.abspath(fname))
+        if (entry is None or entry['source'] != _source_key(fname) or
+                entry.get('job') != self.job or
+                not os.path.exists(scan.output_file_name(fname))):
+            return None
+        return entry['stats']
+
+    def finish(self, fname, stats):
+        self.files[os.path.abspath(fname)] = {
+            'source': _source_key(fname),
+            'job': self.job,
+            'stats': stats,
+        }
+        _write_json(self.fname, self.files)
+        BookCheckpoints(self.directory, fname).clear()
+
+###
+### worker functions. these run in the process pool.
+###
+
+def _init_worker(works, lexicon_fname, budget):
+    tei.set_works(works)
+    if lexicon_fname:
+        from lexicon import QuantityLexicon
+        scan.set_lexicon(QuantityLexicon.load(lexicon_fname))
+    scan.set_budget(budget)
+
+def scan_file(fname, checkpoint_dir, progress, job=None):
+    '''Scan a TEI file, reusing any books already checkpointed, and write
+    the scanned copy. Reports each book's stats to the progress queue as
+    (fname, work, book, stats, resumed) tuples.
+
+    :param job: fingerprint of the job; books checkpointed under another
+        are scanned again
+
+    :rtype: the file's stats
+    '''
+    books = BookCheckpoints(checkpoint_dir, fname, job)
+    stats = scan.new_stats()
+    reader = tei.TEIReader(fname, keep=True, require_work=True)
+
+    book_num = saved = None
+    lines = []
+    book_stats = scan.new_stats()
+    def finish_book():
+        if saved is None:
+            books.save(book_num, lines, book_stats['lexicon_decided'])
+        _add_stats(stats, book_stats)
+        progress.put((fname, reader.work_abbrev, book_num, book_stats,
+                      saved is not None))
+
+    for record in reader:
+        if not lines or record.book_num != book_num:
+            if lines:
+                finish_book()
+            book_num = record.book_num
+            saved = books.load(book_num)
+            lines = []
+            book_stats = scan.new_stats()
+            if saved is not None:
+                book_stats['lexicon_decided'] = saved['lexicon_decided']
+        if saved is not None:
+            analyses = saved['lines'][len(lines)]
+        else:
+            analyses = scan.analyze_record(record, book_stats)
+        lines.append(analyses)
+        scan.record_analyses(record, analyses, book_stats)
+    if lines:
+        finish_book()
+
+    out_fname = scan.output_file_name(fname)
+    tmp_fname = out_fname + '.tmp'
+    with open(tmp_fname, 'wb') as outf:
+        outf.write(ElementTree.tostring(reader.root, encoding='utf-8'))
+    os.replace(tmp_fname, out_fname)
+    return stats
+
+###
+### job control
+###
+
+def _add_stats(total, stats):
+    for key, count in stats.items():
+        total[key] = total.get(key, 0) + count
+
+def _report_progress(progress, total, lock):
+    while True:
+        message = progress.get()
+        if message is None:
+            return
+        fname, work, book_num, book_stats, resumed = message
+        with lock:
+            _add_stats(total, book_stats)
+            print('%s %s.%s: %d lines%s (total %d lines, %d scanned)' %
+                  (os.path.basename(fname), work, book_num,
+                   book_stats['total_lines'], ' (resumed)' if resumed else '',
+                   total['total_lines'], total['scanned'] +
+                   total['multi_match']), flush=True)
+
+def run(fnames, checkpoint, workers=None, works=None, lexicon_fname=None,
+        budget=None):
+    '''Scan files in parallel, skipping those already finished.
+
+    :rtype: tuple of the stats of all lines and a list of files that failed
+    '''
+    total = scan.new_stats()
+    pending = []
+    for fname in fnames:
+        stats = checkpoint.finished(fname)
+        if stats is None:
+            pending.append(fname)
+        else:
+            _add_stats(total, stats)
+            print('%s: already finished' % (fname,))
+
+    failed = []
+    lock = threading.Lock()
+    with Manager() as manager:
+        progress = manager.Queue()
+        reporter = threading.Thread(target=_report_progress,
+                                    args=(progress, total, lock))
+        reporter.start()
+        try:
+            with ProcessPoolExecutor(workers, initializer=_init_worker,
+                                     initargs=(works, lexicon_fname,
+                                               budget)) as pool:
+                futures = {pool.submit(scan_file, fname, checkpoint.directory,
+                                       progress, checkpoint.job): fname
+                           for fname in pending}
+                for done, future in enumerate(as_completed(futures), 1):
+                    fname = futures[future]
+                    try:
+                        stats = future.result()
+                    except Exception as e:
+                        failed.append(fname)
+                        sys.stderr.write('%s: failed: %s\n' % (fname, e))
+                        continue
+                    with lock:
+                        checkpoint.finish(fname, stats)
+                        print('%s: finished (%d of %d files)' %
+                              (fname, done, len(pending)), flush=True)
+        finally:
+            progress.put(None)
+            reporter.join()
+    return total, failed
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', metavar='path', nargs='+',
+                        help='TEI file or directory of them')
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey')
+    parser.add_argument('--checkpoint', metavar='DIR',
+                        default=CHECKPOINT_DIR,
+                        help='directory to keep progress in (default %s)'
+                             % (CHECKPOINT_DIR,))
+    parser.add_argument('--workers', type=int, default=None,
+                        help='worker processes (default: one per CPU)')
+    parser.add_argument('--lexicon', metavar='FILE',
+                        help='consult a vowel quantity lexicon built by '
+                             'lexicon.py')
+    parser.add_argument('--max-seconds', type=float, metavar='SECONDS',
+                        help='abort a line after SECONDS of scanning')
+    args = parser.parse_args()
+
+    works = None
+    if args.works:
+        try:
+            works = tei.load_works(args.works)
+        except ValueError as e:
+            parser.error(str(e))
+    budget = None
+    if args.max_seconds is not None:
+        budget = hexameter.WorkBudget(max_seconds=args.max_seconds)
+    try:
+        job = job_fingerprint(works, args.lexicon, budget)
+    except OSError as e:
+        parser.error(str(e))
+    checkpoint = Checkpoint(args.checkpoint, job)
+    stats, failed = run(find_tei_files(args.paths), checkpoint, args.workers,
+                        works, args.lexicon, budget)
+    if stats['total_lines']:
+        scan.report_stats(stats)
+    if failed:
+        print('Failed files:        %d' % (len(failed),))
+        sys.exit(1)
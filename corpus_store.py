@@ -0,0 +1,259 @@
+'''Compact columnar binary store for a scanned hexameter corpus.
+
+A corpus file holds one row per line in fixed-width little-endian columns:
+
+  work       uint8    index into the works table
+  book       uint16
+  line       uint16
+  scansions  uint8    number of equally likely scansions (0 if unscanned)
+  feet       6 x uint8 per line: code of each foot of the first scansion,
+                      an index into the feet table plus one (0 if unscanned)
+  caesura    uint16   byte offset of the caesura in the line's UTF-8 text,
+                      or NO_CAESURA
+  text       uint32 offsets (one per line, plus one) into a UTF-8 blob
+
+A JSON header records the works table, the feet table (the distinct foot
+scansions seen, such as ``+--`` or ``.+--``), and the offset of each column
+in the file. :class:`CorpusReader` memory-maps the file and exposes the
+columns as typed memoryviews without copying or parsing them, so opening a
+corpus is near-instant. The memoryviews may be handed to
+``numpy.frombuffer`` for vectorized work.
+'''
+
+import json
+import mmap
+import struct
+import sys
+from array import array
+from collections import Counter
+
+import hexameter
+
+MAGIC = b'HEXC'
+VERSION = 1
+NO_CAESURA = 0xffff
+FEET = 6
+
+_PREAMBLE = struct.Struct('<4sII') # magic, version, header length
+_ALIGN = 8
+
+# (column name, array typecode, values per line)
+_COLUMNS = [
+    ('work', 'B', 1),
+    ('book', 'H', 1),
+    ('line', 'H', 1),
+    ('scansions', 'B', 1),
+    ('feet', 'B', FEET),
+    ('caesura', 'H', 1),
+]
+
+def _split_feet(scansion):
+    feet = scansion.split(hexameter.FOOT)
+    if len(feet) != FEET:
+        raise ValueError('not a hexameter scansion: %r' % (scansion,))
+    return feet
+
+class CorpusWriter:
+    '''Accumulate scanned lines and write them as a columnar corpus file.'''
+    def __init__(self):
+        self.works = []
+        self.feet_table = []
+        self._foot_codes = {}
+        self.columns = {name: array(typecode) for name, typecode, _
+                        in _COLUMNS}
+        self.text_offsets = array('I', [0])
+        self.text = bytearray()
+
+    def _work_index(self, work_name, work_abbrev):
+        work = [work_name, work_abbrev]
+        if work not in self.works:
+            self.works.append(work)
+        return self.works.index(work)
+
+    def _foot_code(self, foot):
+        code = self._foot_codes.get(foot)
+        if code is None:
+            self.feet_table.append(foot)
+            code = self._foot_codes[foot] = len(self.feet_table)
+        return code
+
+    def add_line(self, work_name, work_abbrev, book_num, line_num,
+                 line_text, analyses):
+        '''Add a line.
+
+        :param analyses: the line's analyses, as returned by
+            :func:`scan.analyze_line`
+        :raises ValueError: if the line has no work or book number
+        '''
+        if work_abbrev is None:
+            raise ValueError('line %s is not in a known work' % (line_num,))
+        if book_num is None:
+            raise ValueError('line %s of %s has no book number' %
+                             (line_num, work_name))
+        columns = self.columns
+        columns['work'].append(self._work_index(work_name, work_abbrev))
+        columns['book'].append(int(book_num))
+        columns['line'].append(int(line_num))
+        columns['scansions'].append(len(analyses))
+        if analyses:
+            feet = [self._foot_code(f) for f in _split_feet(analyses[0][0])]
+        else:
+            feet = [0] * FEET
+        columns['feet'].extend(feet)
+
+        # as in the scanned TEI, a line with a single caesura is stored as
+        # normalized by the scanner, split at that caesura.
+        caesura = NO_CAESURA
+        caesurae = set(tuple(a[1]) for a in analyses)
+        if len(caesurae) == 1:
+            line_parts = list(caesurae)[0]
+            if len(line_parts) == 2:
+                line_text = ''.join(line_parts)
+                caesura = len(line_parts[0].encode('utf-8'))
+        columns['caesura'].append(caesura)
+        text_bytes = line_text.encode('utf-8')
+
+        self.text.extend(text_bytes)
+        self.text_offsets.append(len(self.text))
+
+    def write(self, fname):
+        sections = [(name, self.columns[name]) for name, _, _ in _COLUMNS]
+        sections.append(('text_offsets', self.text_offsets))
+        sections.append(('text', self.text))
+
+        # lay out sections after the header, each aligned so it can be
+        # cast directly to its type once mapped.
+        header = {
+            'lines': len(self.columns['work']),
+            'works': self.works,
+            'feet': self.feet_table,
+            'sections': {},
+        }
+        def header_bytes():
+            return json.dumps(header, ensure_ascii=False).encode('utf-8')
+        # offsets depend on header length and header length depends on
+        # offsets. iterate until they agree.
+        while True:
+            encoded = header_bytes()
+            offset = _aligned(_PREAMBLE.size + len(encoded))
+            layout = {}
+            for name, data in sections:
+                length = len(_as_bytes(data))
+                layout[name] = [offset, length]
+                offset = _aligned(offset + length)
+            if layout == header['sections']:
+                break
+            header['sections'] = layout
+
+        with open(fname, 'wb') as outf:
+            outf.write(_PREAMBLE.pack(MAGIC, VERSION, len(encoded)))
+            outf.write(encoded)
+            for name, data in sections:
+                section_offset = header['sections'][name][0]
+                outf.write(b'\0' * (section_offset - outf.tell()))
+                outf.write(_as_bytes(data))
+
+def _aligned(offset):
+    return -(-offset // _ALIGN) * _ALIGN
+
+def _as_bytes(data):
+    if isinstance(data, array):
+        if sys.byteorder != 'little':
+            data = array(data.typecode, data)
+            data.byteswap()
+        return data.tobytes()
+    return bytes(data)
+
+class CorpusReader:
+    '''Memory-mapped view of a corpus file written by :class:`CorpusWriter`.
+
+    Columns are available as attributes (``work``, ``book``, ``line``,
+    ``scansions``, ``feet``, ``caesura``, ``text_offsets``) holding typed
+    memoryviews over the mapped file. ``feet`` holds FEET values per line.
+    '''
+    def __init__(self, fname):
+        with open(fname, 'rb') as inf:
+            self._map = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+        buf = memoryview(self._map)
+        magic, version, header_len = _PREAMBLE.unpack_from(buf)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a version %d corpus file' %
+                             (fname, VERSION))
+        if sys.byteorder != 'little':
+            raise ValueError('corpus files can only be mapped on '
+                             'little-endian machines')
+        header = json.loads(bytes(
+            buf[_PREAMBLE.size:_PREAMBLE.size + header_len]).decode('utf-8'))
+        self.works = [tuple(w) for w in header['works']]
+        self.feet_table = header['feet']
+        self._lines = header['lines']
+
+        typecodes = {name: typecode for name, typecode, _ in _COLUMNS}
+        typecodes['text_offsets'] = 'I'
+        for name, (offset, length) in header['sections'].items():
+            section = buf[offset:offset + length]
+            if name in typecodes:
+                section = section.cast(typecodes[name])
+            setattr(self, '_' + name if name == 'text' else name, section)
+
+    def __len__(self):
+        return self._lines
+
+    def close(self):
+        for name in list(vars(self)):
+            if isinstance(getattr(self, name), memoryview):
+                getattr(self, name).release()
+        self._map.close()
+
+    def lineid(self, i):
+        return '%s.%d.%d' % (self.works[self.work[i]][1], self.book[i],
+                             self.line[i])
+
+    def text(self, i):
+        start, end = self.text_offsets[i], self.text_offsets[i + 1]
+        return bytes(self._text[start:end]).decode('utf-8')
+
+    def scansion(self, i):
+        '''The first scansion of line i, or None if it didn't scan.'''
+        codes = self.feet[i * FEET:(i + 1) * FEET]
+        if not codes[0]:
+            return None
+        return hexameter.FOOT.join(self.feet_table[c - 1] for c in codes)
+
+    def line_parts(self, i):
+        '''Line i split at its caesura, as by :func:`scan.analyze_line`.'''
+        text = self.text(i)
+        caesura = self.caesura[i]
+        if caesura == NO_CAESURA:
+            return [text]
+        text_bytes = text.encode('utf-8')
+        return [text_bytes[:caesura].decode('utf-8'),
+                text_bytes[caesura:].decode('utf-8')]
+
+    def foot_column(self, foot):
+        '''Foot codes of every line for one foot (numbered from 1).'''
+        return bytes(self.feet[foot - 1::FEET])
+
+    def dactyl_codes(self):
+        '''Codes of foot scansions containing a dactyl.'''
+        # count shorts rather than matching the foot's end: synizesis may
+        # put a skipped syllable between them, as in +-.-
+        return set(i + 1 for i, f in enumerate(self.feet_table)
+                   if f.count(hexameter.SHORT) == 2)
+
+    def pattern_counts(self, feet=5):
+        '''Count lines by the D/S pattern of their first few feet, e.g.
+        ``DDDDD`` for a line entirely dactylic in the first five feet.
+        Unscanned lines are omitted.'''
+        dactyls = self.dactyl_codes()
+        # translate codes to D/S bytes for all lines at once, then count
+        # fixed-width row slices.
+        table = bytearray(b'S' * 256)
+        table[0] = ord('?')
+        for code in dactyls:
+            table[code] = ord('D')
+        letters = bytes(self.feet).translate(table)
+        counts = Counter(letters[i:i + feet]
+                         for i in range(0, len(letters), FEET))
+        counts.pop(b'?' * feet, None)
+        return Counter({k.decode('ascii'): v for k, v in counts.items()})
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+'''Compare two scanned versions of hexameter TEI files line by line.
+
+Lines are aligned by lineid in a single streaming pass over both versions.
+Each difference is reported with one of these categories:
+
+  changed    scansion changed
+  caesura    scansion unchanged but caesura moved, or the caesurae and
+             diaereses found changed
+  failing    scanned before, fails now
+  scanned    failed before, scans now
+  ambiguous  had one scansion, now has several
+  resolved   had several scansions, now has one
+  missing    line present in only one version
+
+A summary by book follows. The exit status is 1 if there were any
+differences, so the script can gate changes to the scanner.
+'''
+
+import os
+import sys
+from collections import OrderedDict, defaultdict
+from itertools import zip_longest
+
+from tei import iter_lines, load_works, set_works
+
+CATEGORIES = ['changed', 'caesura', 'failing', 'scanned', 'ambiguous',
+              'resolved', 'missing']
+
+def align(old_records, new_records):
+    '''Pair up line records from two versions of a file by lineid.
+
+    Both versions normally list lines in the same order, so records are
+    read in lockstep and only lines that have drifted out of step are held
+    in memory until their partner turns up.
+
+    :rtype: generator of (old, new) pairs, where either may be None if the
+        line is missing from that version
+    '''
+    old_pending = OrderedDict()
+    new_pending = OrderedDict()
+    for old, new in zip_longest(old_records, new_records):
+        if (old is not None and new is not None and
+                old.lineid == new.lineid):
+            yield old, new
+            continue
+        if old is not None:
+            if old.lineid in new_pending:
+                yield old, new_pending.pop(old.lineid)
+            else:
+                old_pending[old.lineid] = old
+        if new is not None:
+            if new.lineid in old_pending:
+                yield old_pending.pop(new.lineid), new
+            else:
+                new_pending[new.lineid] = new
+    for old in old_pending.values():
+        yield old, None
+    for new in new_pending.values():
+        yield None, new
+
+def classify(old, new):
+    '''Categorize the difference between two versions of a line, or return
+    None if they scan the same.'''
+    if old is None or new is None:
+        return 'missing'
+    old_s, new_s = old.scansions, new.scansions
+    if old_s and not new_s:
+        return 'failing'
+    if new_s and not old_s:
+        return 'scanned'
+    if not old_s:
+        return None
+    if len(old_s) == 1 and len(new_s) > 1:
+        return 'ambiguous'
+    if len(old_s) > 1 and len(new_s) == 1:
+        return 'resolved'
+    if old_s != new_s:
+        return 'changed'
+    if old.line_parts != new.line_parts:
+        return 'caesura'
+    if (old.caesurae is not None and new.caesurae is not None and
+            old.caesurae != new.caesurae):
+        return 'caesura'
+    return None
+
+def _describe(record):
+    if record is None:
+        return '(missing)'
+    if not record.scansions:
+        return '(unscanned)'
+    description = ' OR '.join(record.scansions)
+    if record.line_parts is not None:
+        description += ' // %s' % (record.line_parts[1].strip(),)
+    return description
+
+def diff_files(old_fname, new_fname, summary, quiet=False):
+    '''Compare two versions of a scanned TEI file, printing each difference
+    and counting them in summary, a dict mapping (work, book) to a dict of
+    counts by category.'''
+    for old, new in align(iter_lines(old_fname), iter_lines(new_fname)):
+        category = classify(old, new)
+        record = old if old is not None else new
+        book = (record.work_abbrev, record.book_num)
+        summary[book]['lines'] += 1
+        if category is None:
+            continue
+        summary[book][category] += 1
+        if not quiet:
+            print('%-9s %-10s %s -> %s' % (category, record.lineid,
+                                           _describe(old), _describe(new)))
+
+def report_summary(summary):
+    print()
+    print('%-8s %6s ' % ('book', 'lines') +
+          ' '.join('%9s' % (c,) for c in CATEGORIES))
+    totals = defaultdict(int)
+    for (work, book), counts in summary.items():
+        print('%-8s %6d ' % ('%s.%s' % (work, book), counts['lines']) +
+              ' '.join('%9d' % (counts[c],) for c in CATEGORIES))
+        for key, count in counts.items():
+            totals[key] += count
+    print('%-8s %6d ' % ('total', totals['lines']) +
+          ' '.join('%9d' % (totals[c],) for c in CATEGORIES))
+    return sum(totals[c] for c in CATEGORIES)
+
+def file_pairs(old, new):
+    '''Pair up files to compare. old and new may be files or directories;
+    directories are paired by file name.'''
+    if os.path.isdir(old) and os.path.isdir(new):
+        names = sorted(set(os.listdir(old)) & set(os.listdir(new)))
+        return [(os.path.join(old, n), os.path.join(new, n)) for n in names
+                if n.endswith('.xml')]
+    return [(old, new)]
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('old', help='scanned TEI file or directory')
+    parser.add_argument('new', help='scanned TEI file or directory')
+    parser.add_argument('--summary', action='store_true',
+                        help='print only the summary by book')
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey (see bulk_scan.py)')
+    args = parser.parse_args()
+
+    if args.works:
+        try:
+            set_works(load_works(args.works))
+        except ValueError as e:
+            parser.error(str(e))
+
+    summary = defaultdict(lambda: defaultdict(int))
+    for old_fname, new_fname in file_pairs(args.old, args.new):
+        diff_files(old_fname, new_fname, summary, args.summary)
+    differences = report_summary(summary)
+    sys.exit(1 if differences else 0)
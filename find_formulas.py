@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+'''Find repeated phrases (formulas) across scanned hexameter TEI files.'''
+# NB: assumes TEI files were scanned by scan.py
+
+import argparse
+import unicodedata
+from array import array
+from collections import defaultdict
+
+import scan
+from tei import iter_lines, load_works, set_works
+
+# polynomial rolling hash over word ids
+_HASH_BASE = 1000003
+_HASH_MOD = (1 << 61) - 1
+
+###
+### corpus loading
+###
+
+class Corpus:
+    '''Compact in-memory token arrays for a scanned corpus. Each word is
+    stored once as an integer id; per-token data lives in flat arrays
+    indexed from a per-line offset.
+    '''
+    def __init__(self):
+        self.vocab = {}
+        self.words = []
+        self.lines = [] # (lineid, scansion, first token index)
+        self.tokens = array('l')
+        self.sedes = array('d')
+        self.starts = array('l')
+        self.ends = array('l')
+
+    def add_line(self, lineid, line_text, scansion):
+        self.lines.append((lineid, scansion, len(self.tokens)))
+        for word, sedes, start, end in scan.scan_words(line_text, scansion):
+            key = scan.word_key(word)
+            word_id = self.vocab.get(key)
+            if word_id is None:
+                word_id = len(self.words)
+                self.vocab[key] = word_id
+                self.words.append(unicodedata.normalize('NFC', word))
+            self.tokens.append(word_id)
+            self.sedes.append(sedes if sedes is not None else 0)
+            self.starts.append(start if start is not None else -1)
+            self.ends.append(end if end is not None else -1)
+
+    def line_range(self, line_idx):
+        begin = self.lines[line_idx][2]
+        if line_idx + 1 < len(self.lines):
+            end = self.lines[line_idx + 1][2]
+        else:
+            end = len(self.tokens)
+        return begin, end
+
+def load_file(fname, corpus):
+    for record in iter_lines(fname):
+        if not record.scansions:
+            # unscanned lines have no metrical context to report
+            continue
+        corpus.add_line(record.lineid, record.text, record.scansions[0])
+
+###
+### phrase detection
+###
+
+def _ngram_hashes(corpus, n):
+    '''Yield (hash, line index, token index) for every n-word phrase that
+    falls within a single line.
+    '''
+    high = pow(_HASH_BASE, n - 1, _HASH_MOD)
+    tokens = corpus.tokens
+    for line_idx in range(len(corpus.lines)):
+        begin, end = corpus.line_range(line_idx)
+        if end - begin < n:
+            continue
+        h = 0
+        for i in range(begin, begin + n):
+            h = (h * _HASH_BASE + tokens[i] + 1) % _HASH_MOD
+        yield h, line_idx, begin
+        for i in range(begin + n, end):
+            h = (h - (tokens[i - n] + 1) * high) % _HASH_MOD
+            h = (h * _HASH_BASE + tokens[i] + 1) % _HASH_MOD
+            yield h, line_idx, i - n + 1
+
+def find_phrases(corpus, n, min_count):
+    '''Find every n-word phrase occurring at least min_count times.
+
+    Counting happens on hashes alone, so memory for the first pass is one
+    integer per distinct phrase. Only phrases whose hash clears min_count
+    are materialized in the second pass, where they are grouped by their
+    actual words to guard against hash collisions.
+
+    :rtype: list of tuples containing the phrase as a tuple of word ids and
+        a list of (line index, token index) occurrences
+    '''
+    counts = defaultdict(int)
+    for h, line_idx, pos in _ngram_hashes(corpus, n):
+        counts[h] += 1
+    frequent = set(h for h, count in counts.items() if count >= min_count)
+    del counts
+
+    occurrences = defaultdict(list)
+    tokens = corpus.tokens
+    for h, line_idx, pos in _ngram_hashes(corpus, n):
+        if h in frequent:
+            phrase = tuple(tokens[pos:pos + n])
+            occurrences[phrase].append((line_idx, pos))
+
+    return [(phrase, occ) for phrase, occ in occurrences.items()
+            if len(occ) >= min_count]
+
+def find_formulas(corpus, min_words, max_words, min_count, maximal=False):
+    '''Find repeated phrases between min_words and max_words long.
+
+    :param maximal: if true, suppress phrases whose every occurrence is
+        part of a longer reported phrase
+    :rtype: list of tuples containing the phrase as a tuple of word ids and
+        a list of (line index, token index) occurrences, most frequent first
+    '''
+    results = []
+    covered = set() # (token index, length) spans inside reported phrases
+    for n in range(max_words, min_words - 1, -1):
+        for phrase, occ in find_phrases(corpus, n, min_count):
+            if maximal and all((pos, n) in covered for _, pos in occ):
+                continue
+            results.append((phrase, occ))
+            if maximal:
+                for _, pos in occ:
+                    for length in range(min_words, n):
+                        for sub in range(pos, pos + n - length + 1):
+                            covered.add((sub, length))
+    results.sort(key=lambda r: (-len(r[1]), -len(r[0]), r[0]))
+    return results
+
+###
+### reporting
+###
+
+def _format_sedes(sedes):
+    return '%g' % (sedes,) if sedes else '-'
+
+def _scansion_slice(corpus, line_idx, pos, n):
+    scansion = corpus.lines[line_idx][1]
+    starts = [s for s in corpus.starts[pos:pos + n] if s >= 0]
+    ends = [e for e in corpus.ends[pos:pos + n] if e >= 0]
+    if not starts:
+        return ''
+    return scansion[starts[0]:ends[-1]]
+
+def report_formulas(corpus, results):
+    for phrase, occ in results:
+        text = ' '.join(corpus.words[w] for w in phrase)
+        print('%d: %s' % (len(occ), text))
+        for line_idx, pos in occ:
+            lineid = corpus.lines[line_idx][0]
+            # sedes of the first syllable in the phrase
+            sedes = next((s for s in corpus.sedes[pos:pos + len(phrase)]
+                          if s), 0)
+            print('  %-9s %-5s %s' % (lineid, _format_sedes(sedes),
+                  _scansion_slice(corpus, line_idx, pos, len(phrase))))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('fnames', metavar='file.xml', nargs='+',
+                        help='TEI file scanned by scan.py')
+    parser.add_argument('--min-count', type=int, default=2,
+                        help='report phrases repeated at least this often')
+    parser.add_argument('--min-words', type=int, default=2)
+    parser.add_argument('--max-words', type=int, default=6)
+    parser.add_argument('--maximal', action='store_true',
+                        help='omit phrases only found inside longer ones')
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey (see bulk_scan.py)')
+    args = parser.parse_args()
+
+    if args.works:
+        try:
+            set_works(load_works(args.works))
+        except ValueError as e:
+            parser.error(str(e))
+
+    corpus = Corpus()
+    for fname in args.fnames:
+        load_file(fname, corpus)
+    results = find_formulas(corpus, args.min_words, args.max_words,
+                            args.min_count, args.maximal)
+    report_formulas(corpus, results)
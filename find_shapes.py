@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+'''Find words of a given prosodic shape in hexameter sources in solr.'''
+# NB: assumes the word token core was populated by index_tei.py --words-url
+
+from collections import Counter
+import sunburnt
+
+import hexameter
+from find_words import ROWS, iter_results
+from index_tei import fold_text
+
+WORD_SORT_FIELDS = ('work_name', 'book_num', 'line_num', 'word_num')
+
+# letters that may stand for quantities on the command line, where a shape
+# starting with a short would otherwise be taken for an option
+SHAPE_LETTERS = {
+    'L': hexameter.LONG,
+    'S': hexameter.SHORT,
+}
+
+def parse_shape(s):
+    '''Read a shape written with ``+`` and ``-`` or with ``L`` and ``S``,
+    such as ``+--`` or ``LSS``.'''
+    shape = ''.join(SHAPE_LETTERS.get(c.upper(), c) for c in s)
+    if not shape or set(shape) - set((hexameter.LONG, hexameter.SHORT)):
+        raise ValueError('invalid shape %r (expected + and - or L and S)'
+                         % (s,))
+    return shape
+
+def build_query(solr, shape, sedes=None, caesura_side=None, word=None):
+    '''Build a query for word tokens of a shape such as ``+--``, optionally
+    restricted to a sedes, to one side of the caesura, or to a word.'''
+    query = solr.query(shape=shape)
+    if sedes is not None:
+        query = query.query(sedes=sedes)
+    if caesura_side is not None:
+        query = query.query(caesura_side=caesura_side)
+    if word is not None:
+        query = query.query(word_folded=fold_text(word))
+    return query
+
+def report_tokens(query, rows=ROWS):
+    def print_count(num_found):
+        print('%d hits:' % (num_found,))
+
+    for token in iter_results(query, rows, print_count, WORD_SORT_FIELDS):
+        print('%-9s %-5s %-6s %s' % (token['lineid'], token.get('sedes', ''),
+                                     token['shape'], token['word']))
+
+def report_word_counts(query, rows=ROWS):
+    counts = Counter(token['word'] for token
+                     in iter_results(query, rows,
+                                     sort_fields=WORD_SORT_FIELDS))
+    print('%d distinct words:' % (len(counts),))
+    for word, count in counts.most_common():
+        print('%6d %s' % (count, word))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('solr_url', help='URL of the word token core')
+    parser.add_argument('shape',
+                        help='quantities to match, e.g. +-- or LSS; write '
+                             'shapes starting with a short as letters, '
+                             'e.g. SSLL')
+    parser.add_argument('--sedes',
+                        help='metrical position of the first syllable in '
+                             'half-feet, e.g. 1 or 6.5')
+    side = parser.add_mutually_exclusive_group()
+    side.add_argument('--before-caesura', dest='caesura_side',
+                      action='store_const', const='before')
+    side.add_argument('--after-caesura', dest='caesura_side',
+                      action='store_const', const='after')
+    parser.add_argument('--word', help='limit to one word, ignoring accents')
+    parser.add_argument('--count', action='store_true',
+                        help='list distinct words by frequency instead of '
+                             'every occurrence')
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='results to fetch per request (default %d)'
+                             % (ROWS,))
+    args = parser.parse_args()
+
+    try:
+        shape = parse_shape(args.shape)
+    except ValueError as e:
+        parser.error(str(e))
+    solr = sunburnt.SolrInterface(args.solr_url)
+    query = build_query(solr, shape, args.sedes, args.caesura_side,
+                        args.word)
+    if args.count:
+        report_word_counts(query, args.rows)
+    else:
+        report_tokens(query, args.rows)
@@ -3,44 +3,270 @@
 '''Find words from hexameter sources in solr.'''
 # NB: assumes solr was populated by index_tei.py or equivalent
 
-import unicodedata
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import heapq
+import json
+import sys
+import threading
+import time
 import sunburnt
 
-def report_results(base_query):
-    ROWS = 10
-    start = 0
-
-    query = base_query.sort_by('work_name').sort_by('book_num') \
-                      .sort_by('line_num')
-    response = query.paginate(start=start, rows=ROWS).execute()
-    print('%d hits:' % (response.result.numFound,))
-    
-    while list(response):
-        for match in response:
-            scans = match.get('scansion', None)
-            if not scans:
-                scans = ['']
-
-            if 'before_caesura' in match and 'after_caesura' in match:
-                line = '%s // %s' % (match['before_caesura'].strip(),
-                                     match['after_caesura'].strip())
+from index_tei import fold_text
+
+# default number of results fetched per request
+ROWS = 1000
+# default number of queries run at once in batch mode
+WORKERS = 8
+
+# fields results are ordered by. together they must identify a document.
+SORT_FIELDS = ('work_name', 'book_num', 'line_num')
+
+def _sorted(query, sort_fields=SORT_FIELDS):
+    for field in sort_fields:
+        query = query.sort_by(field)
+    return query
+
+def _after(query, last_match, sort_fields=SORT_FIELDS):
+    '''Restrict a query to results sorting after last_match. This is
+    keyset ("cursor") paging: every page is a fresh query from the top of
+    the sort order, so deep pages cost no more than the first one.'''
+    if last_match is None:
+        return query
+    Q = query.Q
+    after = None
+    # a result sorts after last_match if it ties on some leading fields
+    # and is greater on the next.
+    for i, field in enumerate(sort_fields):
+        clause = Q(**{field + '__gt': last_match[field]})
+        for tied in sort_fields[:i]:
+            clause = Q(**{tied: last_match[tied]}) & clause
+        after = clause if after is None else after | clause
+    return query.filter(after)
+
+def _fetch_page(query, last_match, rows, sort_fields):
+    response = _after(query, last_match, sort_fields) \
+                   .paginate(start=0, rows=rows).execute()
+    return response.result.numFound, list(response)
+
+def iter_results(base_query, rows=ROWS, on_count=None,
+                 sort_fields=SORT_FIELDS):
+    '''Generate every match for a query in work, book, and line order.
+
+    Results are fetched a page at a time, and the next page is requested
+    in the background while the caller consumes the current one. At most
+    two pages are held in memory regardless of the number of hits.
+
+    :param on_count: optional callable, called once with the total number
+        of hits as soon as the first page arrives
+    :param sort_fields: fields to order results by, which together must
+        identify a document
+    '''
+    query = _sorted(base_query, sort_fields)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        num_found, page = _fetch_page(query, None, rows, sort_fields)
+        if on_count is not None:
+            on_count(num_found)
+        while page:
+            if len(page) < rows:
+                # short page: this is the last one.
+                pending = None
             else:
-                line = match['line_text']
+                pending = executor.submit(_fetch_page, query, page[-1],
+                                          rows, sort_fields)
+            for match in page:
+                yield match
+            if pending is None:
+                break
+            _, page = pending.result()
 
-            print('%-9s %-22s %s' % (match['lineid'], scans[0], line)) 
-            for scan in scans[1:]:
-                print('%-9s %-22s %s' % ('', scan, '  alternate scansion'))
-        start += ROWS
-        response = query.paginate(start=start, rows=ROWS).execute()
+def _first_match(results):
+    return next(results, None)
 
+def _from_first(first, results):
+    if first is None:
+        return
+    yield first
+    for match in results:
+        yield match
 
-if __name__ == '__main__':
-    import sys
-    if len(sys.argv) < 3:
-        print('Usage: %s solr_url word ...')
-    solr_url = sys.argv[1]
-    solr = sunburnt.SolrInterface(solr_url)
+def iter_merged(base_queries, rows=ROWS, on_count=None,
+                sort_fields=SORT_FIELDS):
+    '''Generate every match for a query run against several cores, such as
+    one core per work, merged into a single work, book, and line order.
+
+    The first page from every core is requested at once, and after that
+    each core is paged independently by :func:`iter_results`, so at most
+    two pages per core are held in memory.
+
+    :param base_queries: the query built for each core
+    :param on_count: optional callable, called once with the total number
+        of hits across all cores as soon as every core has answered
+    '''
+    counts = []
+    streams = [iter_results(query, rows, counts.append, sort_fields)
+               for query in base_queries]
+    with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+        firsts = list(executor.map(_first_match, streams))
+    if on_count is not None:
+        on_count(sum(counts))
+    def sort_key(match):
+        return tuple(match[field] for field in sort_fields)
+    merged = heapq.merge(*[_from_first(first, stream) for first, stream
+                           in zip(firsts, streams)], key=sort_key)
+    for match in merged:
+        yield match
+
+def format_match(match):
+    '''Format a match as report lines: the line with its first scansion,
+    then any alternate scansions.'''
+    scans = match.get('scansion', None)
+    if not scans:
+        scans = ['']
+
+    if 'before_caesura' in match and 'after_caesura' in match:
+        line = '%s // %s' % (match['before_caesura'].strip(),
+                             match['after_caesura'].strip())
+    else:
+        line = match['line_text']
+
+    lines = ['%-9s %-22s %s' % (match['lineid'], scans[0], line)]
+    for scan in scans[1:]:
+        lines.append('%-9s %-22s %s' % ('', scan, '  alternate scansion'))
+    return lines
+
+def report_results(base_queries, rows=ROWS):
+    def print_count(num_found):
+        print('%d hits:' % (num_found,))
+
+    for match in iter_merged(base_queries, rows, print_count):
+        for line in format_match(match):
+            print(line)
+
+
+def build_query(solr, words, exact=False):
+    '''Build a query matching lines containing all of words. By default
+    words are folded and matched against the accent-insensitive
+    line_text_folded field; with exact, they must match accents too.'''
     query = solr # not really, but it will after the first iteration of:
-    for word in sys.argv[2:]:
-        query = query.query(unicode(word, 'utf-8'))
-    report_results(query)
+    for word in words:
+        if exact:
+            query = query.query(word)
+        else:
+            query = query.query(line_text_folded=fold_text(word))
+    return query
+
+###
+### batch queries
+###
+
+class ConnectionPool:
+    '''Hand each worker thread its own connection to each solr core,
+    created on first use and reused for every later query on that
+    thread.'''
+    def __init__(self, solr_urls):
+        self.solr_urls = solr_urls
+        self.local = threading.local()
+
+    def get(self):
+        cores = getattr(self.local, 'cores', None)
+        if cores is None:
+            cores = [sunburnt.SolrInterface(url) for url in self.solr_urls]
+            self.local.cores = cores
+        return cores
+
+def _match_record(match):
+    keys = ('lineid', 'scansion', 'line_text', 'before_caesura',
+            'after_caesura')
+    return {k: match[k] for k in keys if k in match}
+
+def run_batch_query(pool, query_s, write, exact=False, rows=ROWS):
+    '''Run a single query from a batch, passing write a record for each
+    match as it arrives, then a summary of the query's hit count and the
+    time taken in seconds. Matches are streamed, so memory doesn't grow
+    with the number of hits.'''
+    started = time.time()
+    queries = [build_query(solr, [query_s], exact) for solr in pool.get()]
+    counts = []
+    for match in iter_merged(queries, rows, counts.append):
+        record = _match_record(match)
+        record['query'] = query_s
+        write(record)
+    write({
+        'query': query_s,
+        'hits': counts[0],
+        'seconds': round(time.time() - started, 4),
+    })
+
+def run_batch(solr_urls, queries, outf, exact=False, rows=ROWS,
+              workers=WORKERS):
+    '''Run many queries concurrently against every core in solr_urls,
+    writing JSON lines to outf: one per match, tagged with its query, and
+    a summary for each query once it finishes. A query that fails ends
+    with an error in place of its summary.'''
+    pool = ConnectionPool(solr_urls)
+    lock = threading.Lock()
+    def write(record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        with lock:
+            outf.write(line)
+            if 'lineid' not in record:
+                outf.flush()
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(run_batch_query, pool, q, write, exact,
+                                   rows): q
+                   for q in queries}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                write({'query': futures[future], 'error': str(e)})
+    elapsed = time.time() - started
+    sys.stderr.write('%d queries in %.2fs\n' % (len(futures), elapsed))
+
+def read_queries(inf):
+    '''Read one query per line, skipping blank lines.'''
+    for line in inf:
+        line = line.strip()
+        if line:
+            yield line
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('solr_url',
+                        help='URL of the solr core to search, or the URLs '
+                             'of several separated by commas')
+    parser.add_argument('words', metavar='word', nargs='*')
+    parser.add_argument('--exact', action='store_true',
+                        help='match accents and breathings exactly')
+    parser.add_argument('--rows', type=int, default=ROWS,
+                        help='results to fetch per request (default %d)'
+                             % (ROWS,))
+    parser.add_argument('--batch', metavar='FILE',
+                        help="run one query per line of FILE ('-' for "
+                             'stdin), writing JSON lines to stdout')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='queries to run at once in batch mode '
+                             '(default %d)' % (WORKERS,))
+    args = parser.parse_args()
+    solr_urls = args.solr_url.split(',')
+
+    if args.batch:
+        if args.batch == '-':
+            queries = list(read_queries(sys.stdin))
+        else:
+            with open(args.batch) as inf:
+                queries = list(read_queries(inf))
+        run_batch(solr_urls, queries, sys.stdout, args.exact, args.rows,
+                  args.workers)
+        sys.exit(0)
+    if not args.words:
+        parser.error('give words to search for, or --batch')
+
+    queries = [build_query(sunburnt.SolrInterface(url), args.words,
+                           args.exact)
+               for url in solr_urls]
+    report_results(queries, args.rows)
@@ -1,4 +1,7 @@
-from collections import defaultdict
+import logging
+import random
+import time
+from collections import OrderedDict, defaultdict
 
 LONG = '+'
 SHORT = '-'
@@ -84,6 +87,12 @@ FOOT = '|'
 # scansion, we allow SHORT_SYLLABLES to fill in for LONG_SYLLABLES. We give
 # this an arbitrarily high cost so that the path is only taken as a last
 # resort.
+#
+# Each of these costs is a weighted count of a few prosodic features:
+# correption, synizesis, a short syllable scanned as long, and a spondee
+# in the fifth foot. FeatureScansionNFA below tracks those counts along
+# each path instead of a single summed cost, so that candidate scansions
+# can be stored once and re-ranked under different weights.
 
 LONG_SYLLABLES = [ LONG, INDETERMINATE, LONG_CORREPTION, INDETERMINATE_CORREPTION ]
 SHORT_SYLLABLES = [ SHORT, INDETERMINATE, INDETERMINATE_CORREPTION, SHORT_SYNIZESIS ]
@@ -92,6 +101,35 @@ CORREPTED_SYNIZESIS = [ LONG_CORREPTION, INDETERMINATE_CORREPTION ]
 SYNIZESIS_SYLLABLES = [ SHORT_SYNIZESIS ]
 ALL_SYLLABLES = [ LONG, SHORT, INDETERMINATE, LONG_CORREPTION, INDETERMINATE_CORREPTION, SHORT_SYNIZESIS ]
 
+class BudgetExceeded(Exception):
+    '''Raised when scanning a line exceeds its :class:`WorkBudget`.'''
+
+class WorkBudget:
+    '''Limits on the work spent scanning a single line. Any limit may be
+    None.
+
+    :param max_frontier: most paths the NFA may follow at once
+    :param max_states: most path states it may expand over the whole line
+    :param max_seconds: most wall time it may take
+    '''
+    def __init__(self, max_frontier=None, max_states=None, max_seconds=None):
+        self.max_frontier = max_frontier
+        self.max_states = max_states
+        self.max_seconds = max_seconds
+
+    def check(self, frontier, expanded, started):
+        if self.max_frontier is not None and frontier > self.max_frontier:
+            raise BudgetExceeded('frontier of %d paths exceeds %d' %
+                                 (frontier, self.max_frontier))
+        if self.max_states is not None and expanded > self.max_states:
+            raise BudgetExceeded('%d states expanded exceeds %d' %
+                                 (expanded, self.max_states))
+        if self.max_seconds is not None:
+            elapsed = time.monotonic() - started
+            if elapsed > self.max_seconds:
+                raise BudgetExceeded('%.2fs elapsed exceeds %.2fs' %
+                                     (elapsed, self.max_seconds))
+
 class ScansionNFA:
     TRANSITION_TABLE = [
         #(from_state, accept_syllables,    to_state, cost, scan_as)
@@ -268,8 +306,11 @@ class ScansionNFA:
         for syllable in syllables:
             transitions[(from_state, syllable)].append((to_state, cost, scan_as))
 
-    def __init__(self):
+    def __init__(self, budget=None):
         self.states = [ (self.START_STATE, 0, '') ] # state, cost, scansion
+        self.budget = budget
+        self.expanded = 0
+        self.started = time.monotonic()
 
     def input(self, syllables):
         for syllable in syllables:
@@ -285,13 +326,337 @@ class ScansionNFA:
                 new_states.append((new_state, new_cost, new_scansion))
 
         self.states = new_states
+        self._spend(len(new_states))
+
+    def _spend(self, expanded):
+        self.expanded += expanded
+        if self.budget is not None:
+            self.budget.check(len(self.states), self.expanded, self.started)
 
     def results(self):
         return sorted([(s[1], s[2]) for s in self.states
                       if s[0] == self.ACCEPT_STATE])
 
 
-def normalize(scansion):
-    nfa = ScansionNFA()
+FEATURES = ('correption', 'synizesis', 'short_as_long', 'fifth_foot_spondee')
+# weights reproducing the costs in ScansionNFA.TRANSITION_TABLE
+DEFAULT_WEIGHTS = (1, 1, 15, 1)
+
+def _transition_features(from_state, syllables, to_state, cost, scan_as):
+    '''Count the prosodic features a transition table entry represents.'''
+    correption = int(scan_as.startswith(SHORT) and
+                     (syllables is CORREPTED_SYLLABLES or
+                      syllables is CORREPTED_SYNIZESIS))
+    synizesis = int(syllables is SYNIZESIS_SYLLABLES and scan_as == SKIPPED)
+    short_as_long = int(syllables is SHORT_SYLLABLES and
+                        scan_as.startswith(LONG))
+    fifth_foot_spondee = int(to_state == 35 and scan_as == LONG + FOOT)
+    return (correption, synizesis, short_as_long, fifth_foot_spondee)
+
+def weigh(features, weights=DEFAULT_WEIGHTS):
+    return sum(f * w for f, w in zip(features, weights))
+
+class FeatureScansionNFA(ScansionNFA):
+    '''A ScansionNFA that records a vector of feature counts (see FEATURES)
+    along each path in place of a summed cost.'''
+    feature_transitions = defaultdict(list)
+    for row in ScansionNFA.TRANSITION_TABLE:
+        from_state, syllables, to_state, cost, scan_as = row
+        features = _transition_features(*row)
+        # the feature model must agree with the hand-tuned costs.
+        assert weigh(features) == cost, row
+        for syllable in syllables:
+            feature_transitions[(from_state, syllable)].append(
+                (to_state, features, scan_as))
+    del row, from_state, syllables, to_state, cost, scan_as, features
+
+    def __init__(self, budget=None):
+        ScansionNFA.__init__(self, budget)
+        self.states = [ (self.START_STATE, (0,) * len(FEATURES), '') ]
+
+    def transition(self, syllable):
+        new_states = []
+        for old_state, old_features, old_scansion in self.states:
+            transitions = self.feature_transitions[(old_state, syllable)]
+            for new_state, path_features, path_scansion in transitions:
+                new_features = tuple(a + b for a, b
+                                     in zip(old_features, path_features))
+                new_scansion = old_scansion + (path_scansion or '')
+                new_states.append((new_state, new_features, new_scansion))
+
+        self.states = new_states
+        self._spend(len(new_states))
+
+    def results(self):
+        '''All distinct accepting paths, as (scansion, features) tuples.'''
+        return sorted(set((s[2], s[1]) for s in self.states
+                          if s[0] == self.ACCEPT_STATE))
+
+
+# path states kept by a FrontierCache unless told otherwise. a state takes
+# roughly 150 bytes, so this is about 15 MB.
+FRONTIER_CACHE_STATES = 100000
+
+class _TrieNode:
+    __slots__ = ('parent', 'syllable', 'children', 'states')
+
+    def __init__(self, parent=None, syllable=None):
+        self.parent = parent
+        self.syllable = syllable
+        self.children = {}
+        self.states = None
+
+class FrontierCache:
+    '''ScansionNFA frontiers after prefixes of preliminary analyses.
+
+    Formulaic lines share long opening prefixes, and an editor re-scans a
+    line after every keystroke, so scanning can often resume from the
+    frontier left by an earlier analysis. Prefixes are kept in a trie, one
+    syllable per level. A frontier may hold a handful of paths or
+    thousands, so the cache is bounded by the path states in all its
+    frontiers together: at most max_states are kept, the least recently
+    used frontiers are discarded first, and a frontier larger than the
+    whole cache isn't kept at all.
+    '''
+    def __init__(self, max_states=FRONTIER_CACHE_STATES):
+        self.max_states = max_states
+        self.root = _TrieNode()
+        self.lru = OrderedDict() # nodes holding frontiers
+        self.stored = 0 # path states in all cached frontiers
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.lru)
+
+    def get(self, prefix):
+        '''The frontier after prefix, or None if it isn't cached.'''
+        node = self.root
+        for syllable in prefix:
+            node = node.children.get(syllable)
+            if node is None:
+                break
+        if node is None or node.states is None:
+            self.misses += 1
+            return None
+        self.lru.move_to_end(node)
+        self.hits += 1
+        return node.states
+
+    def longest_prefix(self, analysis):
+        '''Find the longest prefix of analysis with a cached frontier.
+
+        :rtype: tuple of the prefix length and its frontier, or (0, None)
+            if no prefix is cached
+        '''
+        node = self.root
+        found = (0, None)
+        found_node = None
+        for i, syllable in enumerate(analysis):
+            node = node.children.get(syllable)
+            if node is None:
+                break
+            if node.states is not None:
+                found = (i + 1, node.states)
+                found_node = node
+        if found_node is None:
+            self.misses += 1
+            return found
+        self.lru.move_to_end(found_node)
+        self.hits += 1
+        return found
+
+    def put(self, prefix, states):
+        states = tuple(states)
+        if len(states) > self.max_states:
+            return
+        node = self.root
+        for syllable in prefix:
+            child = node.children.get(syllable)
+            if child is None:
+                child = node.children[syllable] = _TrieNode(node, syllable)
+            node = child
+        if node.states is not None:
+            self.stored -= len(node.states)
+        node.states = states
+        self.stored += len(states)
+        self.lru[node] = None
+        self.lru.move_to_end(node)
+        while self.stored > self.max_states:
+            self._evict(self.lru.popitem(last=False)[0])
+
+    def _evict(self, node):
+        self.stored -= len(node.states)
+        node.states = None
+        # prune branches left with nothing cached
+        while (node.parent is not None and node.states is None and
+               not node.children):
+            del node.parent.children[node.syllable]
+            node = node.parent
+
+class IncrementalScanner:
+    '''Scan a preliminary analysis a syllable at a time, optionally sharing
+    frontiers with other scans through a :class:`FrontierCache`.'''
+    def __init__(self, cache=None, budget=None):
+        self.cache = cache
+        self.budget = budget
+        self.reset()
+
+    def reset(self):
+        self.prefix = ''
+        self.nfa = ScansionNFA(self.budget)
+
+    def feed(self, syllable):
+        '''Extend the analysis scanned so far by one syllable.'''
+        self.prefix += syllable
+        states = None
+        if self.cache is not None:
+            states = self.cache.get(self.prefix)
+        if states is not None:
+            self.nfa.states = list(states)
+            return
+        self.nfa.transition(syllable)
+        if self.cache is not None:
+            self.cache.put(self.prefix, self.nfa.states)
+
+    def scan(self, analysis):
+        '''Scan a whole preliminary analysis, resuming from the longest
+        prefix in the cache.
+
+        :rtype: sorted list of (cost, scansion) tuples, as from
+            :func:`normalize`
+        '''
+        self.reset()
+        if self.cache is not None:
+            length, states = self.cache.longest_prefix(analysis)
+            if states is not None:
+                self.prefix = analysis[:length]
+                self.nfa.states = list(states)
+        for syllable in analysis[len(self.prefix):]:
+            self.prefix += syllable
+            self.nfa.transition(syllable)
+            if self.cache is not None:
+                self.cache.put(self.prefix, self.nfa.states)
+        return self.results()
+
+    def results(self):
+        return self.nfa.results()
+
+_frontier_cache = FrontierCache()
+
+def set_frontier_cache(max_states=FRONTIER_CACHE_STATES):
+    '''Replace the frontier cache used by the ``cached`` engine with an
+    empty one holding at most max_states path states.'''
+    global _frontier_cache
+    _frontier_cache = FrontierCache(max_states)
+
+def _nfa_normalize(scansion, budget=None):
+    nfa = ScansionNFA(budget)
     nfa.input(scansion)
     return nfa.results()
+
+def _feature_normalize(scansion, budget=None):
+    return rank(candidates(scansion, budget))
+
+def _cached_normalize(scansion, budget=None):
+    return IncrementalScanner(_frontier_cache, budget).scan(scansion)
+
+# Scansion engines take a preliminary analysis string and an optional
+# WorkBudget, and return the string's possible scansions as sorted
+# (cost, scansion) tuples, raising BudgetExceeded if they run over the
+# budget. ScansionNFA is the reference: any other engine must find the
+# same scansions at the same costs, which shadow checking verifies on a
+# sample of lines.
+REFERENCE_ENGINE = 'nfa'
+_engines = {
+    REFERENCE_ENGINE: _nfa_normalize,
+    'features': _feature_normalize,
+    'cached': _cached_normalize,
+}
+_engine = _nfa_normalize
+_shadow = None
+
+logger = logging.getLogger(__name__)
+
+class ShadowCheck:
+    '''Cross-check a random sample of an engine's results against the
+    reference engine, counting and logging any divergence.
+
+    :param sample: fraction of calls to check, from 0 to 1
+    '''
+    def __init__(self, engine_name, sample, seed=None):
+        self.engine_name = engine_name
+        self.sample = sample
+        self.random = random.Random(seed)
+        self.checked = 0
+        self.diverged = 0
+
+    def check(self, scansion, results, budget=None):
+        if self.random.random() >= self.sample:
+            return
+        try:
+            expected = _engines[REFERENCE_ENGINE](scansion, budget)
+        except BudgetExceeded:
+            return
+        self.checked += 1
+        # engines needn't agree on duplicate paths to the same scansion
+        if set(results) != set(expected):
+            self.diverged += 1
+            logger.warning('engine %s diverged from %s on %r: %r != %r',
+                           self.engine_name, REFERENCE_ENGINE, scansion,
+                           sorted(set(results)), sorted(set(expected)))
+
+def register_engine(name, engine):
+    '''Make a scansion engine available to :func:`set_engine`.
+
+    :param engine: function taking a preliminary analysis string and a
+        :class:`WorkBudget` or None, and returning sorted (cost, scansion)
+        tuples, as :func:`normalize` does
+    '''
+    _engines[name] = engine
+
+def engine_names():
+    return sorted(_engines)
+
+def set_engine(name=REFERENCE_ENGINE, shadow_sample=0.0, seed=None):
+    '''Select the engine used by :func:`normalize`.
+
+    :param shadow_sample: fraction of lines to cross-check against the
+        reference engine
+    :rtype: the :class:`ShadowCheck` counting divergences, or None if not
+        cross-checking
+    '''
+    global _engine, _shadow
+    if name not in _engines:
+        raise ValueError('unknown scansion engine %r' % (name,))
+    _engine = _engines[name]
+    _shadow = None
+    if shadow_sample and name != REFERENCE_ENGINE:
+        _shadow = ShadowCheck(name, shadow_sample, seed)
+    return _shadow
+
+def normalize(scansion, budget=None):
+    '''Find every possible scansion of a preliminary analysis with the
+    selected engine.
+
+    :param budget: optional :class:`WorkBudget`. If scanning exceeds it,
+        raises :class:`BudgetExceeded`.
+    :rtype: sorted list of (cost, scansion) tuples
+    '''
+    results = _engine(scansion, budget)
+    if _shadow is not None:
+        _shadow.check(scansion, results, budget)
+    return results
+
+def candidates(scansion, budget=None):
+    '''Find every possible scansion of a preliminary analysis with its
+    feature counts, for ranking later with :func:`rank`.'''
+    nfa = FeatureScansionNFA(budget)
+    nfa.input(scansion)
+    return nfa.results()
+
+def rank(candidates, weights=DEFAULT_WEIGHTS):
+    '''Rank candidates from :func:`candidates` under a set of feature
+    weights, returning (cost, scansion) tuples as :func:`normalize` does.'''
+    return sorted((weigh(features, weights), scansion)
+                  for scansion, features in candidates)
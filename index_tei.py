@@ -2,90 +2,294 @@
 
 '''Index hexameter lines from a TEI file in solr.'''
 
+import functools
+import hashlib
+import json
+import operator
+import os
 import unicodedata
-from xml.etree import ElementTree
-import sunburnt
 
-def index_file(fname, solr_url):
+import hexameter
+import scan
+from tei import iter_lines
+
+# documents sent to solr per request
+BATCH_SIZE = 500
+
+def index_file(fname, solr_url, manifest=None):
+    '''Index every line of a scanned TEI file.
+
+    :param manifest: optional dict mapping lineid to the hash of the
+        document last indexed for that line and the file it came from, as
+        loaded by :func:`load_manifest`. If given, only new and changed
+        lines are sent to solr, lines last indexed from this file that no
+        longer exist in it are deleted, and the manifest is updated in
+        place.
+    :rtype: tuple of the lineids sent to solr and the lineids deleted
+    '''
+    # imported here so the rest of this module works without a solr client
+    import sunburnt
     solr = sunburnt.SolrInterface(solr_url)
+    work_name = None
+    source = os.path.abspath(fname)
+    seen = set()
+    batch = []
+    changed = []
+    for line_data in line_documents(fname):
+        work_name = line_data['work_name']
+        lineid = line_data['lineid']
+        if manifest is not None:
+            seen.add(lineid)
+            entry = {'hash': document_hash(line_data), 'file': source}
+            if manifest.get(lineid) == entry:
+                continue
+            manifest[lineid] = entry
 
-    with open(fname) as inf:
-        in_s = inf.read()
-    tei = ElementTree.XML(in_s)
-    work_name, work_abbrev = identify_work(tei)
-
-    text = tei.find('text')
-    book_num = None
-    line_num = 0
-    for node in text.iter():
-        if node.tag == 'div1' and node.get('type') == 'Book':
-            # new book. update our location.
-            book_num = node.get('n')
-            print('Indexing %s book %s' % (work_name, book_num))
-            line_num = 0
-        elif node.tag == 'l':
-            # line. index it.
-            if node.get('n'):
-                line_num = int(node.get('n'))
-            else:
-                line_num += 1
+        batch.append(line_data)
+        changed.append(lineid)
+        if len(batch) >= BATCH_SIZE:
+            solr.add(batch)
+            batch = []
+    if batch:
+        solr.add(batch)
 
-            scansion_val = node.get('real')
-            if scansion_val:
-                scansion = scansion_val.split(' OR ')
-            else:
-                scansion = []
+    deleted = []
+    if manifest is not None:
+        # only this file's lines: a work may be split across several
+        # files. entries from older manifests record no file; they are
+        # rewritten as their lines are indexed again.
+        deleted = [old_id for old_id, entry in manifest.items()
+                   if isinstance(entry, dict) and entry['file'] == source
+                   and old_id not in seen]
+        for i in range(0, len(deleted), BATCH_SIZE):
+            solr.delete(deleted[i:i+BATCH_SIZE])
+        for old_id in deleted:
+            del manifest[old_id]
 
-            line_text = ''.join(node.itertext())
-            caesura_node = node.find('caesura')
-            if caesura_node is not None:
-                after_caesura = caesura_node.tail
-                before_caesura = line_text[:-len(after_caesura)]
-            else:
-                after_caesura = None
-                before_caesura = None
-
-            # FIXME: having a lot of difficulty getting solr to index and
-            # search this text unless it's NFC all the way through, even if
-            # the appropriate filters are set in the solr schema. for now,
-            # convert it all to NFC herE.
-            line_text = unicodedata.normalize('NFC', line_text)
-            if before_caesura:
-                before_caesura = unicodedata.normalize('NFC', before_caesura)
-            if after_caesura:
-                after_caesura = unicodedata.normalize('NFC', after_caesura)
-
-            line_data = {
-                'lineid': '%s.%s.%d' % (work_abbrev, book_num, line_num),
-                'work_name': work_name,
-                'book_num': book_num,
-                'line_num': line_num,
-                'line_text': line_text,
-                'scansion': scansion,
-                'before_caesura': before_caesura,
-                'after_caesura': after_caesura,
+    print('%s: %d lines added or changed, %d deleted' %
+          (work_name, len(changed), len(deleted)))
+    if changed or deleted:
+        solr.commit()
+    return changed, deleted
+
+def index_words(fname, solr_url, lineids=None, deleted=()):
+    '''Index the words of a scanned TEI file, with their prosodic shapes,
+    in a word token core configured with solr/words/schema.xml.
+
+    :param lineids: lineids whose words to index, as returned by
+        :func:`index_file`. Tokens previously indexed for these lines and
+        for the ``deleted`` lineids are removed first. If None, every line
+        is indexed, replacing all tokens previously indexed from this file.
+    '''
+    import sunburnt
+    solr = sunburnt.SolrInterface(solr_url)
+    if lineids is None:
+        solr.delete(queries=solr.Q(source_file=os.path.abspath(fname)))
+    else:
+        lineids = set(lineids)
+        stale = sorted(lineids.union(deleted))
+        for i in range(0, len(stale), BATCH_SIZE):
+            query = functools.reduce(
+                operator.or_, (solr.Q(lineid=lineid)
+                               for lineid in stale[i:i+BATCH_SIZE]))
+            solr.delete(queries=query)
+    work_name = None
+    batch = []
+    count = 0
+    for word_data in word_documents(fname):
+        work_name = word_data['work_name']
+        if lineids is not None and word_data['lineid'] not in lineids:
+            continue
+        batch.append(word_data)
+        if len(batch) >= BATCH_SIZE:
+            solr.add(batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        solr.add(batch)
+        count += len(batch)
+    print('%s: %d words indexed' % (work_name, count))
+    if lineids is None or lineids or deleted:
+        solr.commit()
+
+def word_documents(fname):
+    '''Generate a solr document for each word of each scanned line in a
+    TEI file.'''
+    source = os.path.abspath(fname)
+    for record in iter_lines(fname, require_work=True):
+        if not record.scansions:
+            continue
+        shapes = scan.word_shapes(record.text, record.scansions[0])
+        for i, (word, sedes, shape, before_caesura) in enumerate(shapes):
+            if not shape:
+                # elided particles and the like have no syllables to
+                # search by
+                continue
+            word_data = {
+                'tokenid': '%s.%d' % (record.lineid, i + 1),
+                'lineid': record.lineid,
+                'source_file': source,
+                'work_name': record.work_name,
+                'book_num': record.book_num,
+                'line_num': record.line_num,
+                'word_num': i + 1,
+                'word': unicodedata.normalize('NFC', word),
+                'word_folded': fold_text(word),
+                'shape': shape,
+                'sedes': '%g' % (sedes,),
             }
+            if before_caesura is not None:
+                word_data['caesura_side'] = \
+                    'before' if before_caesura else 'after'
+            yield word_data
 
-            solr.add(line_data)
-    solr.commit()
+def line_documents(fname):
+    '''Generate a solr document for each line of a scanned TEI file.
+    Raises ValueError if the file's title matches no known work.'''
+    for record in iter_lines(fname, require_work=True):
+        line_text = record.text
+        if record.line_parts is not None:
+            before_caesura, after_caesura = record.line_parts
+        else:
+            after_caesura = None
+            before_caesura = None
 
-# FIXME: either find a better way to identify the title, or else make the
-# user enter them at the command line
-def identify_work(tei):
-    title_node = tei.find('teiHeader/fileDesc/titleStmt/title')
-    title = title_node.text
+        # FIXME: having a lot of difficulty getting solr to index and
+        # search this text unless it's NFC all the way through, even if
+        # the appropriate filters are set in the solr schema. for now,
+        # convert it all to NFC here, and store accent-folded copies
+        # alongside for accent-insensitive searching.
+        line_text, line_text_folded = _search_forms(line_text)
+        before_caesura, before_caesura_folded = \
+            _search_forms(before_caesura)
+        after_caesura, after_caesura_folded = _search_forms(after_caesura)
 
-    if 'Iliad' in title:
-        return ('Iliad', 'Il')
-    elif 'Odyssey' in title:
-        return ('Odyssey', 'Od')
+        line_data = {
+            'lineid': record.lineid,
+            'work_name': record.work_name,
+            'book_num': record.book_num,
+            'line_num': record.line_num,
+            'line_text': line_text,
+            'scansion': record.scansions,
+            'before_caesura': before_caesura,
+            'after_caesura': after_caesura,
+            'line_text_folded': line_text_folded,
+            'before_caesura_folded': before_caesura_folded,
+            'after_caesura_folded': after_caesura_folded,
+        }
+        line_data.update(scansion_facets(record.text, record.scansions))
+        caesurae = record_caesurae(record)
+        if caesurae:
+            line_data['caesurae'] = caesurae
+
+        yield line_data
+
+def scansion_facets(line_text, scansions):
+    '''Derive single-valued facet fields from a line's scansions: D or S for
+    each of the first five feet, the five-foot pattern (e.g. DDDDD),
+    syllable count, caesura type, and whether the line scans more than one
+    way. Fields describe the first scansion. Unscanned lines get only the
+    multiple_scansion flag.'''
+    facets = {'multiple_scansion': len(scansions) > 1}
+    if not scansions:
+        return facets
+    scansion = scansions[0]
+    feet = scansion.split(hexameter.FOOT)
+    # count shorts rather than matching the foot's end: synizesis may put
+    # a skipped syllable between them, as in +-.-
+    pattern = ''.join('D' if foot.count(hexameter.SHORT) == 2 else 'S'
+                      for foot in feet[:5])
+    for i, foot_type in enumerate(pattern):
+        facets['foot%d' % (i + 1,)] = foot_type
+    facets['pattern'] = pattern
+    facets['syllables'] = sum(1 for c in scansion
+                              if c in (hexameter.LONG, hexameter.SHORT))
+    caesura = scan.caesura_type(line_text, scansion)
+    if caesura:
+        facets['caesura_type'] = caesura
+    return facets
+
+def record_caesurae(record):
+    '''Name every caesura and diaeresis found in any scansion of a line,
+    from the scanned TEI if it recorded them, otherwise by finding them.'''
+    caesurae = record.caesurae
+    if caesurae is None:
+        caesurae = [scan.caesura_names(scan.caesura_flags(record.text, s))
+                    for s in record.scansions]
+    names = set(name for names in caesurae for name in names)
+    return [name for flag, name in scan.CAESURA_FLAGS if name in names]
+
+def document_hash(line_data):
+    '''Hash the full content of a line document, covering its text,
+    scansion and caesura, to detect lines that need reindexing.'''
+    content = json.dumps(line_data, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+def load_manifest(fname):
+    '''Load a manifest of indexed lines written by :func:`save_manifest`,
+    or an empty one if the file doesn't exist yet.'''
+    if not os.path.exists(fname):
+        return {}
+    with open(fname) as inf:
+        return json.load(inf)
+
+def save_manifest(manifest, fname):
+    # write to the side and rename so an interrupted run never leaves a
+    # truncated manifest behind.
+    tmp_fname = fname + '.tmp'
+    with open(tmp_fname, 'w') as outf:
+        json.dump(manifest, outf, sort_keys=True)
+    os.replace(tmp_fname, fname)
+
+def fold_text(s):
+    '''Reduce text to an accent-insensitive search form: strip all
+    diacriticals (accents, breathings, diaeresis, iota subscript),
+    normalize final sigma to medial, and lowercase.
+    '''
+    decomposed = unicodedata.normalize('NFD', s)
+    stripped = ''.join(c for c in decomposed
+                       if unicodedata.category(c) != 'Mn')
+    return stripped.lower().replace('\u03c2', '\u03c3') # final sigma
+
+def _search_forms(s):
+    '''Return the NFC and folded forms of s, or (None, None) if s is
+    None.'''
+    if s is None:
+        return (None, None)
+    return (unicodedata.normalize('NFC', s), fold_text(s))
 
 
 if __name__ == '__main__':
-    import sys
-    if len(sys.argv) < 3:
-        print('Usage: %s solr_url file.xml ...')
-    solr_url = sys.argv[1]
-    fnames = sys.argv[2:]
-    for fname in fnames:
-        index_file(fname, solr_url)
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('solr_url')
+    parser.add_argument('fnames', metavar='file.xml', nargs='+')
+    parser.add_argument('--manifest', metavar='FILE',
+                        help='index only lines changed since the run that '
+                             'wrote FILE, and record this run in it')
+    parser.add_argument('--words-url', metavar='URL',
+                        help='also index each word and its prosodic shape '
+                             'in the word token core at URL')
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey (see bulk_scan.py)')
+    args = parser.parse_args()
+
+    if args.works:
+        from tei import load_works, set_works
+        try:
+            set_works(load_works(args.works))
+        except ValueError as e:
+            parser.error(str(e))
+    manifest = None
+    if args.manifest:
+        manifest = load_manifest(args.manifest)
+    for fname in args.fnames:
+        changed, deleted = index_file(fname, args.solr_url, manifest)
+        if manifest is not None:
+            save_manifest(manifest, args.manifest)
+        if args.words_url:
+            if manifest is None:
+                index_words(fname, args.words_url)
+            else:
+                index_words(fname, args.words_url, changed, deleted)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''Learn natural vowel quantities of word forms from the corpus.
+
+Alpha, iota and upsilon may be long or short, and unless position or
+accent decides the matter, the scanner has to treat them as indeterminate
+and let the line as a whole decide. Many word forms recur throughout the
+corpus, though, and wherever a line scans unambiguously, the scansion
+shows how each of those vowels was realized. A quantity lexicon records,
+for each word form, the natural length of every vowel that was realized
+consistently across all such lines, so later scans can start from known
+lengths.
+'''
+
+import json
+from collections import defaultdict
+
+import hexameter
+import scan
+from tei import iter_lines, load_works, set_works
+
+# realized vowels are only trusted from lines scanning below the cost of
+# reading a short syllable as long (see hexameter.ScansionNFA)
+_MAX_COST = 15
+# occurrences needed before a quantity is recorded
+MIN_COUNT = 2
+
+class QuantityLexicon:
+    '''Natural vowel lengths of word forms.
+
+    Entries map a word form (see :func:`scan.word_key`) to a string with one
+    character per vowel cluster in the word: LONG, SHORT, or
+    INDETERMINATE where the lexicon doesn't know.
+    '''
+    def __init__(self, entries=None):
+        self.entries = entries or {}
+
+    def lengths(self, word):
+        return self.entries.get(word)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname) as inf:
+            return cls(json.load(inf))
+
+    def save(self, fname):
+        with open(fname, 'w') as outf:
+            json.dump(self.entries, outf, ensure_ascii=False, sort_keys=True,
+                      indent=0)
+
+class LexiconBuilder:
+    '''Collect realized vowel quantities from unambiguously scanned lines.'''
+    def __init__(self):
+        # word -> vowel position -> realized length -> count
+        self.observations = defaultdict(
+            lambda: defaultdict(lambda: defaultdict(int)))
+        self.vowel_counts = {}
+        self.lines_used = 0
+
+    def learn_line(self, line):
+        '''Learn from a line if it scans unambiguously. Returns True if the
+        line was used.'''
+        metrical_analysis = scan.preliminary_analysis(line, use_lexicon=False)
+        analysis_s = ''.join(m[1] for m in metrical_analysis)
+        normalizations = hexameter.normalize(analysis_s)
+        if not normalizations:
+            return False
+        best_cost, scansion = normalizations[0]
+        if best_cost >= _MAX_COST:
+            return False
+        if len(normalizations) > 1 and normalizations[1][0] == best_cost:
+            return False
+
+        merge = scan.merge_scansion(metrical_analysis, scansion)
+        realized = {}
+        cluster_idx = 0
+        for cluster, prelim, final in merge:
+            if not cluster:
+                # foot marker
+                continue
+            realized[cluster_idx] = (prelim, final)
+            cluster_idx += 1
+        # the final syllable of the line is anceps and tells us nothing.
+        last_vowel = max(i for i, (prelim, _) in realized.items() if prelim)
+
+        clusters = [m[0] for m in metrical_analysis]
+        for word, vowels in scan.word_vowels(clusters):
+            key = scan.word_key(word)
+            self.vowel_counts[key] = len(vowels)
+            for position, i in enumerate(vowels):
+                prelim, final = realized[i]
+                if (prelim == hexameter.INDETERMINATE and i != last_vowel and
+                        final in (hexameter.LONG, hexameter.SHORT)):
+                    self.observations[key][position][final] += 1
+        self.lines_used += 1
+        return True
+
+    def build(self, min_count=MIN_COUNT):
+        '''Build a lexicon of quantities that were realized the same way
+        every time, at least min_count times.'''
+        entries = {}
+        for word, positions in self.observations.items():
+            lengths = [hexameter.INDETERMINATE] * self.vowel_counts[word]
+            for position, counts in positions.items():
+                if len(counts) == 1:
+                    length, count = list(counts.items())[0]
+                    if count >= min_count:
+                        lengths[position] = length
+            if any(l != hexameter.INDETERMINATE for l in lengths):
+                entries[word] = ''.join(lengths)
+        return QuantityLexicon(entries)
+
+def learn_file(fname, builder):
+    for record in iter_lines(fname):
+        builder.learn_line(record.text)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('lexicon', metavar='lexicon.json',
+                        help='file to write the lexicon to')
+    parser.add_argument('fnames', metavar='file.xml', nargs='+',
+                        help='Unicode TEI file to learn from')
+    parser.add_argument('--min-count', type=int, default=MIN_COUNT,
+                        help='occurrences needed to record a quantity '
+                             '(default %d)' % (MIN_COUNT,))
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey (see bulk_scan.py)')
+    args = parser.parse_args()
+
+    if args.works:
+        try:
+            set_works(load_works(args.works))
+        except ValueError as e:
+            parser.error(str(e))
+
+    builder = LexiconBuilder()
+    for fname in args.fnames:
+        learn_file(fname, builder)
+    lexicon = builder.build(args.min_count)
+    lexicon.save(args.lexicon)
+    print('Learned quantities for %d word forms from %d lines' %
+          (len(lexicon.entries), builder.lines_used))
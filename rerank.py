@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+'''Store candidate scansions with their feature counts, and re-rank them
+under new cost weights without re-scanning.
+
+The scanner ranks candidate scansions by a cost built from a few prosodic
+features (see hexameter.FEATURES). ``rerank.py extract`` records every
+candidate scansion of every line with its feature counts, once.
+``rerank.py rank`` then applies a set of weights to those stored
+candidates and reports how the corpus would scan under them, and which
+lines would change from the current weights.
+'''
+
+import json
+
+import hexameter
+import scan
+from tei import iter_lines, load_works, set_works
+
+def line_candidates(line):
+    '''Every possible scansion of a line with its feature counts.
+
+    :rtype: list of (scansion, features) tuples
+    '''
+    metrical_analysis = scan.preliminary_analysis(line)
+    analysis_s = ''.join(m[1] for m in metrical_analysis)
+    return hexameter.candidates(analysis_s)
+
+def extract_file(fname, outf):
+    for record in iter_lines(fname):
+        entry = {
+            'lineid': record.lineid,
+            'candidates': line_candidates(record.text),
+        }
+        outf.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+def load_candidates(inf):
+    '''Read candidate sets written by :func:`extract_file`.
+
+    :rtype: generator of (lineid, candidates) tuples
+    '''
+    for line in inf:
+        entry = json.loads(line)
+        yield entry['lineid'], [(scansion, tuple(features)) for
+                                scansion, features in entry['candidates']]
+
+def best_scansions(candidates, weights=hexameter.DEFAULT_WEIGHTS):
+    '''The distinct lowest-cost scansions of a line under a set of
+    weights.'''
+    ranked = hexameter.rank(candidates, weights)
+    if not ranked:
+        return []
+    best_cost = ranked[0][0]
+    return sorted(set(scansion for cost, scansion in ranked
+                      if cost == best_cost))
+
+def parse_weights(specs):
+    '''Build a weight vector from the defaults and a list of
+    ``feature=weight`` strings.'''
+    weights = list(hexameter.DEFAULT_WEIGHTS)
+    for spec in specs:
+        name, _, value = spec.partition('=')
+        if name not in hexameter.FEATURES:
+            raise ValueError('unknown feature %r (expected one of %s)' %
+                             (name, ', '.join(hexameter.FEATURES)))
+        weights[hexameter.FEATURES.index(name)] = int(value)
+    return tuple(weights)
+
+def rank_corpus(candidate_sets, weights, show_changes=False):
+    '''Re-rank stored candidate sets under weights, comparing against the
+    default weights.'''
+    stats = {
+        'total_lines': 0,
+        'scanned': 0,
+        'multi_match': 0,
+        'changed': 0,
+    }
+    for lineid, candidates in candidate_sets:
+        stats['total_lines'] += 1
+        best = best_scansions(candidates, weights)
+        if best:
+            stats['scanned'] += 1
+        if len(best) > 1:
+            stats['multi_match'] += 1
+        default = best_scansions(candidates)
+        if best != default:
+            stats['changed'] += 1
+            if show_changes:
+                print('%-10s %s -> %s' % (lineid, ' OR '.join(default),
+                                          ' OR '.join(best)))
+    return stats
+
+def report_stats(stats, weights):
+    print('Weights: ' + ', '.join('%s=%d' % item for item
+                                  in zip(hexameter.FEATURES, weights)))
+    print('Total lines: %d' % (stats['total_lines'],))
+    print('Scanned: %d' % (stats['scanned'],))
+    print('Multiple scansions: %d' % (stats['multi_match'],))
+    print('Changed from default weights: %d' % (stats['changed'],))
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    extract = commands.add_parser('extract',
+                                  help='record candidate scansions')
+    extract.add_argument('candidates', metavar='candidates.jsonl',
+                         help='file to write candidate sets to')
+    extract.add_argument('fnames', metavar='file.xml', nargs='+',
+                         help='Unicode TEI file to scan')
+    extract.add_argument('--lexicon', metavar='FILE',
+                         help='consult a vowel quantity lexicon built by '
+                              'lexicon.py')
+    extract.add_argument('--works', metavar='FILE',
+                         help='JSON manifest of works to recognize besides '
+                              'the Iliad and Odyssey (see bulk_scan.py)')
+
+    rank = commands.add_parser('rank', help='re-rank candidate scansions')
+    rank.add_argument('candidates', metavar='candidates.jsonl',
+                      help='candidate sets written by extract')
+    rank.add_argument('--weight', metavar='FEATURE=WEIGHT', action='append',
+                      default=[],
+                      help='override a feature weight; may be repeated. '
+                           'Features: ' + ', '.join(hexameter.FEATURES))
+    rank.add_argument('--changes', action='store_true',
+                      help='list lines whose best scansions change')
+    args = parser.parse_args()
+
+    if args.command == 'extract':
+        if args.works:
+            try:
+                set_works(load_works(args.works))
+            except ValueError as e:
+                parser.error(str(e))
+        if args.lexicon:
+            from lexicon import QuantityLexicon
+            scan.set_lexicon(QuantityLexicon.load(args.lexicon))
+        with open(args.candidates, 'w') as outf:
+            for fname in args.fnames:
+                extract_file(fname, outf)
+    else:
+        try:
+            weights = parse_weights(args.weight)
+        except ValueError as e:
+            parser.error(str(e))
+        with open(args.candidates) as inf:
+            stats = rank_corpus(load_candidates(inf), weights, args.changes)
+        report_stats(stats, weights)
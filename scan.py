@@ -5,6 +5,7 @@ import unicodedata
 from xml.etree import ElementTree
 
 import hexameter
+import tei
 
 ###
 ### constants and handy definitions
@@ -95,6 +96,17 @@ _SYNIZESIS_CANDIDATES = [
     '\u03b5\u0301', # epsilon with acute
     ]
 
+# quantity lexicon consulted for vowels of indeterminate length. see
+# set_lexicon() and lexicon.py.
+_lexicon = None
+
+# work budget for scanning each line. see set_budget().
+_budget = None
+
+# value of the ana attribute marking a TEI line whose scan was abandoned
+# for exceeding the work budget
+ABORTED = 'scan-aborted'
+
 ###
 ### utility functions
 ###
@@ -168,20 +180,21 @@ def _cluster(glyphs):
 ### syllable length analysis
 ###
 
-def _metrical_length(clusters, i):
+def _metrical_length(clusters, i, known_length=None):
+    '''Preliminary metrical analysis of a single cluster.
+
+    :param known_length: natural length of this vowel (LONG or SHORT) if
+        known from the quantity lexicon, or None
+    '''
     c = clusters[i]
     if _get_cluster_type(c) != _VOWEL:
         # if you're not a vowel, you don't get counted directly in
         # metrical analysis.
         return (c, '')
 
-    unaccented = _strip_diacriticals(c)
-    # natural length
-    if len(unaccented) > 1:
-        # diphthong
-        length = hexameter.LONG
-    else:
-        length = _VOWEL_LENGTH_MAP.get(unaccented, hexameter.INDETERMINATE)
+    length = _natural_length(c)
+    if length == hexameter.INDETERMINATE and known_length:
+        length = known_length
 
     # circumflex is always on a long
     if '\u0342' in c: # circumflex
@@ -202,6 +215,14 @@ def _metrical_length(clusters, i):
 
     return (c, length)
 
+def _natural_length(c):
+    '''Natural length of a vowel cluster as far as its spelling shows.'''
+    unaccented = _strip_diacriticals(c)
+    if len(unaccented) > 1:
+        # diphthong
+        return hexameter.LONG
+    return _VOWEL_LENGTH_MAP.get(unaccented, hexameter.INDETERMINATE)
+
 # FIXME: is this the best way to check for synizesis?
 def _synizesis_candidate(cluster):
     return (cluster in _SYNIZESIS_CANDIDATES)
@@ -258,7 +279,7 @@ def _followed_by_vowel_in_same_word(clusters, i):
 ### identify ceasura
 ###
 
-def _merge_scansion(metrical_analysis, scansion):
+def merge_scansion(metrical_analysis, scansion):
     '''Merge preliminary metrical analysis from this module with a scansion
     provided by :func:`scan.normalize`. 
 
@@ -339,6 +360,105 @@ def _locate_caesura(metrical_analysis):
     # otherwise, we didn't find a caesura.
     return None
 
+def _caesura_position(metrical_analysis, caesura_idx):
+    '''Locate a word break in the meter.
+
+    :rtype: tuple of the foot containing the break (numbered from 1) and
+        the number of syllables of that foot before it
+    '''
+    foot = 1
+    syllables = 0
+    for cluster, prelim, scansion in metrical_analysis[:caesura_idx]:
+        if scansion == hexameter.FOOT:
+            foot += 1
+            syllables = 0
+        elif scansion and scansion != hexameter.SKIPPED:
+            syllables += 1
+    return (foot, syllables)
+
+def _caesura_name(foot, syllables):
+    if foot == 3:
+        return 'masculine' if syllables == 1 else 'feminine'
+    if foot == 4 and syllables == 1:
+        return 'hephthemimeral'
+    return 'late'
+
+def caesura_type(line, scansion):
+    '''Classify the primary caesura of a scanned line: ``masculine`` (after
+    the first syllable of the third foot), ``feminine`` (after the second
+    syllable of a dactylic third foot), ``hephthemimeral`` (after the first
+    syllable of the fourth foot), or ``late`` (anywhere after that).
+
+    :param line: string
+    :param scansion: one scansion of the line, as returned by
+        :func:`analyze_line`
+    :rtype: string, or None if the line has no caesura
+    '''
+    merge = merge_scansion(preliminary_analysis(line), scansion)
+    caesura = _locate_caesura(merge)
+    if caesura is None:
+        return None
+    return _caesura_name(*_caesura_position(merge, caesura))
+
+# every caesura and diaeresis of interest, as bit flags
+TRITHEMIMERAL = 0x01     # after the first syllable of the second foot
+MASCULINE = 0x02         # penthemimeral: after the first of the third
+FEMININE = 0x04          # after the second syllable of a dactylic third
+HEPHTHEMIMERAL = 0x08    # after the first syllable of the fourth foot
+BUCOLIC_DIAERESIS = 0x10 # between the fourth and fifth feet
+
+CAESURA_FLAGS = [
+    (TRITHEMIMERAL, 'trithemimeral'),
+    (MASCULINE, 'masculine'),
+    (FEMININE, 'feminine'),
+    (HEPHTHEMIMERAL, 'hephthemimeral'),
+    (BUCOLIC_DIAERESIS, 'bucolic'),
+    ]
+
+# (foot, syllables of that foot before a word break) -> flag
+_FLAG_POSITIONS = {
+    (2, 1): TRITHEMIMERAL,
+    (3, 1): MASCULINE,
+    (3, 2): FEMININE,
+    (4, 1): HEPHTHEMIMERAL,
+    (5, 0): BUCOLIC_DIAERESIS,
+    }
+
+def _caesura_flags(metrical_analysis):
+    '''Find every caesura and diaeresis in a line in a single pass.
+
+    :param metrical_analysis: list of tuples containing a character
+        cluster, a preliminary metrical analysis, and a final scansion
+    :rtype: int, a combination of the flags in CAESURA_FLAGS
+    '''
+    flags = 0
+    foot = 1
+    syllables = 0
+    for cluster, prelim, scansion in metrical_analysis:
+        if scansion == hexameter.FOOT:
+            foot += 1
+            syllables = 0
+        elif scansion and scansion != hexameter.SKIPPED:
+            syllables += 1
+        elif ' ' in cluster:
+            flags |= _FLAG_POSITIONS.get((foot, syllables), 0)
+    return flags
+
+def caesura_flags(line, scansion):
+    '''Find every caesura and diaeresis in a scanned line.
+
+    :param line: string
+    :param scansion: one scansion of the line, as returned by
+        :func:`analyze_line`
+    :rtype: int, a combination of the flags in CAESURA_FLAGS
+    '''
+    merge = merge_scansion(preliminary_analysis(line), scansion)
+    return _caesura_flags(merge)
+
+def caesura_names(flags):
+    '''Name the caesurae and diaereses in a set of flags.'''
+    return [name for flag, name in CAESURA_FLAGS if flags & flag]
+
 def _split_line(metrical_analysis, caesura_idx):
     '''Split the analyzed line into two strings, split at the identified
     caesura.
@@ -368,23 +488,222 @@ def _split_line(metrical_analysis, caesura_idx):
         pre_s = pre_s + caesura_s
     return (pre_s, post_s)
 
+###
+### word-level analysis
+###
+
+def _sedes(foot, syllable):
+    '''Conventional metrical position of a syllable, counted in half-feet:
+    the first element of foot n is at 2n-1, the second at 2n, and the second
+    short of a dactyl at 2n+0.5.
+    '''
+    if syllable <= 2:
+        return 2 * foot - 1 + (syllable - 1)
+    return 2 * foot + 0.5
+
+def _word_spans(metrical_analysis):
+    '''Split merged metrical analysis into words.
+
+    :param metrical_analysis: list of tuples containing a character
+        cluster, a preliminary metrical analysis, and a final scansion, as
+        returned by :func:`merge_scansion`
+    :rtype: list of tuples containing the word, its sedes, and the start
+        and end offsets of its syllables in the scansion string
+    '''
+    words = []
+    word = ''
+    sedes = None
+    start = end = None
+    foot = 1
+    syllable = 0
+    offset = 0
+    for cluster, prelim, scansion in metrical_analysis:
+        if scansion == hexameter.FOOT:
+            foot += 1
+            syllable = 0
+            offset += 1
+            continue
+
+        if _get_cluster_type(cluster) == _OTHER:
+            if any(c.isspace() for c in cluster) and word:
+                words.append((word, sedes, start, end))
+                word = ''
+                sedes = start = end = None
+            continue
+
+        word += cluster
+        if scansion:
+            if start is None:
+                start = offset
+            end = offset + 1
+            if scansion != hexameter.SKIPPED:
+                syllable += 1
+                if sedes is None:
+                    sedes = _sedes(foot, syllable)
+            offset += 1
+
+    if word:
+        words.append((word, sedes, start, end))
+    return words
+
+def scan_words(line, scansion):
+    '''Split a scanned line of epic hexameter into words and locate each
+    word in the meter.
+
+    :param line: string
+    :param scansion: one scansion of the line, as returned by
+        :func:`analyze_line`
+    :rtype: list of tuples. Each tuple contains a word (lowercase NFD), its
+        sedes (the metrical position of its first syllable, counted in
+        half-feet from 1 to 12), and the start and end offsets of the
+        word's syllables within ``scansion``. Offsets are None for words
+        with no syllables.
+    '''
+    metrical_analysis = preliminary_analysis(line)
+    merge = merge_scansion(metrical_analysis, scansion)
+    return _word_spans(merge)
+
+
+def word_shapes(line, scansion):
+    '''Split a scanned line of epic hexameter into words with their
+    prosodic shapes.
+
+    :param line: string
+    :param scansion: one scansion of the line, as returned by
+        :func:`analyze_line`
+    :rtype: list of tuples. Each tuple contains a word (lowercase NFD), its
+        sedes (as for :func:`scan_words`), its shape (the LONG and SHORT
+        quantities of its syllables, without foot or synizesis markers),
+        and whether it falls before the primary caesura. The last is None
+        if the line has no caesura or the word has no syllables.
+    '''
+    merge = merge_scansion(preliminary_analysis(line), scansion)
+    caesura = _locate_caesura(merge)
+    caesura_sedes = None
+    if caesura is not None:
+        foot, syllables = _caesura_position(merge, caesura)
+        caesura_sedes = _sedes(foot, syllables + 1)
+
+    shapes = []
+    for word, sedes, start, end in _word_spans(merge):
+        if start is None:
+            shapes.append((word, sedes, '', None))
+            continue
+        shape = ''.join(c for c in scansion[start:end]
+                        if c in (hexameter.LONG, hexameter.SHORT))
+        before_caesura = None
+        if caesura_sedes is not None and sedes is not None:
+            before_caesura = sedes < caesura_sedes
+        shapes.append((word, sedes, shape, before_caesura))
+    return shapes
+
+###
+### quantity lexicon
+###
+
+def set_lexicon(lexicon):
+    '''Consult a quantity lexicon for the natural length of vowels that
+    can't be determined from spelling alone.
+
+    :param lexicon: a :class:`lexicon.QuantityLexicon`, or None to stop
+        consulting one
+    '''
+    global _lexicon
+    _lexicon = lexicon
+
+def word_key(word):
+    '''Normalize a word (as a string of lowercase NFD clusters) for lookup
+    in the quantity lexicon or comparison with other occurrences. Grave
+    accents only stand in for a final acute, so fold them to acute.'''
+    return word.replace('\u0300', '\u0301') # grave -> acute
+
+def word_vowels(clusters):
+    '''Group the vowel clusters of a line by word.
+
+    :rtype: list of tuples containing a word and a list of the indices of
+        its vowel clusters
+    '''
+    words = []
+    word = ''
+    vowels = []
+    for i, cluster in enumerate(clusters):
+        cluster_type = _get_cluster_type(cluster)
+        if cluster_type == _OTHER:
+            if any(c.isspace() for c in cluster) and word:
+                words.append((word, vowels))
+                word = ''
+                vowels = []
+            continue
+        word += cluster
+        if cluster_type == _VOWEL:
+            vowels.append(i)
+    if word:
+        words.append((word, vowels))
+    return words
+
+def _lexicon_lengths(clusters):
+    '''Look up each word of a line in the quantity lexicon.
+
+    :rtype: dict mapping cluster index to LONG or SHORT for each vowel
+        whose natural length the lexicon knows
+    '''
+    known = {}
+    for word, vowels in word_vowels(clusters):
+        lengths = _lexicon.lengths(word_key(word))
+        if lengths is None or len(lengths) != len(vowels):
+            continue
+        for i, length in zip(vowels, lengths):
+            if length in (hexameter.LONG, hexameter.SHORT):
+                known[i] = length
+    return known
 
 ###
 ### tie it all together and scan a line
 ###
 
-def _local_metrical_analysis(line):
+def preliminary_analysis(line, use_lexicon=True):
+    '''Analyze the natural and positional length of each character cluster
+    of a line, before scanning the line as a whole.
+
+    :param use_lexicon: whether to consult the quantity lexicon set with
+        :func:`set_lexicon`
+    :rtype: list of tuples containing a character cluster and its
+        preliminary metrical analysis, as taken by :func:`merge_scansion`
+    '''
+    return _analyze_clusters(line, use_lexicon)[0]
+
+def _analyze_clusters(line, use_lexicon=True):
+    '''Preliminary metrical analysis of a line.
+
+    :rtype: tuple of the analysis and the number of vowel quantities the
+        quantity lexicon decided in it
+    '''
     line = unicodedata.normalize('NFD', line)
     line = line.lower()
     glyphs = _glyphs(line)
     clusters = _cluster(glyphs)
-    metrical_analysis = [_metrical_length(clusters, i)
+    known = {}
+    if use_lexicon and _lexicon is not None:
+        known = _lexicon_lengths(clusters)
+    metrical_analysis = [_metrical_length(clusters, i, known.get(i))
                          for i in range(len(clusters))]
-    return metrical_analysis
+    decided = sum(1 for i in known
+                  if _natural_length(clusters[i]) == hexameter.INDETERMINATE)
+    return metrical_analysis, decided
+
+def set_budget(budget):
+    '''Limit the work spent scanning each line.
+
+    :param budget: a :class:`hexameter.WorkBudget`, or None for no limit.
+        Lines exceeding it raise :class:`hexameter.BudgetExceeded` from
+        :func:`analyze_line`.
+    '''
+    global _budget
+    _budget = budget
 
 def _scan(metrical_analysis):
     analysis_s = ''.join(m[1] for m in metrical_analysis)
-    normalizations = hexameter.normalize(analysis_s)
+    normalizations = hexameter.normalize(analysis_s, _budget)
     if not normalizations:
         return []
 
@@ -393,62 +712,110 @@ def _scan(metrical_analysis):
                  if n[0] == best_cost]
     return scansions
 
-def analyze_line(line):
+def analyze_line(line, with_flags=False, stats=None):
     '''Analyze scansion and caesura placement for a single line of epic
     hexameter.
 
     :param line: string
+    :param with_flags: if true, add the scansion's caesura flags (see
+        :func:`caesura_flags`) to each tuple
+    :param stats: optional stats dict (see :func:`new_stats`) in which to
+        count the vowel quantities the quantity lexicon decided
     :rtype: list of tuples. Each tuple contains a possible scansion and a
         list of line parts, split at the caesura. If no caesura could be
         found, the list will contain only a single part.
+    :raises hexameter.BudgetExceeded: if scanning the line exceeded the
+        budget set with :func:`set_budget`
     '''
-    metrical_analysis = _local_metrical_analysis(line)
+    metrical_analysis, decided = _analyze_clusters(line)
     scansions = _scan(metrical_analysis)
+    if stats is not None:
+        stats['lexicon_decided'] += decided
     result = []
     for scansion in scansions:
-        merge = _merge_scansion(metrical_analysis, scansion)
+        merge = merge_scansion(metrical_analysis, scansion)
         caesura = _locate_caesura(merge)
         if caesura is not None:
             line_parts = _split_line(merge, caesura)
         else:
             line_parts = [line]
-        result.append((scansion, line_parts))
+        if with_flags:
+            result.append((scansion, line_parts, _caesura_flags(merge)))
+        else:
+            result.append((scansion, line_parts))
     return result
 
 ###
 ### file/stream processing
 ###
 
-def process_tei_file(fname, stats):
-    with open(fname) as inf:
-        in_s = inf.read()
-    tei = ElementTree.XML(in_s)
-    text = tei.find('text')
-    for line_node in text.iter('l'):
-        line = ''.join(line_node.itertext())
-        stats['total_lines'] += 1
-        analyses = analyze_line(line)
-        if not analyses:
-            stats['no_match'] += 1
-            continue
-        if len(analyses) > 1:
-            stats['multi_match'] += 1
-        else:
-            stats['scanned'] += 1
-        update_line_node(line_node, analyses)
-
+def process_tei_file(fname, stats, corpus=None):
+    '''Scan every line of a TEI file, writing a copy with scansion and
+    caesura added.
 
-    out_s = ElementTree.tostring(tei, encoding='utf-8')
+    :param corpus: optional :class:`corpus_store.CorpusWriter` to receive
+        each line and its analyses
+    '''
+    reader = tei.TEIReader(fname, keep=True)
+    for record in reader:
+        analyses = analyze_record(record, stats)
+        if corpus is not None:
+            try:
+                corpus.add_line(record.work_name, record.work_abbrev,
+                                record.book_num, record.line_num,
+                                record.text, analyses or [])
+            except ValueError as e:
+                raise ValueError('%s: %s' % (fname, e))
+        record_analyses(record, analyses, stats)
+
+
+    out_s = ElementTree.tostring(reader.root, encoding='utf-8')
     out_fname = output_file_name(fname)
     with open(out_fname, 'w+b') as outf:
         outf.write(out_s)
 
+def analyze_record(record, stats=None):
+    '''Analyze a :class:`tei.LineRecord`.
+
+    :param stats: as for :func:`analyze_line`
+
+    :rtype: the line's analyses with their caesura flags, as from
+        :func:`analyze_line`, or None if scanning it exceeded the work
+        budget
+    '''
+    try:
+        return analyze_line(record.text, with_flags=True, stats=stats)
+    except hexameter.BudgetExceeded:
+        return None
+
+def record_analyses(record, analyses, stats):
+    '''Count a line's analyses in stats and add them to its TEI node.'''
+    stats['total_lines'] += 1
+    if analyses is None:
+        stats['aborted'] += 1
+        record.node.set('ana', ABORTED)
+        return
+    if not analyses:
+        stats['no_match'] += 1
+        return
+    if len(analyses) > 1:
+        stats['multi_match'] += 1
+    else:
+        stats['scanned'] += 1
+    update_line_node(record.node, analyses)
+
 def update_line_node(line_node, analyses):
     # add scansions
     scansions = [a[0] for a in analyses]
     scansion_s = ' OR '.join(scansions)
     line_node.set('real', scansion_s)
 
+    # add every caesura and diaeresis of each scansion
+    if all(len(a) > 2 for a in analyses):
+        caesurae_s = ' OR '.join(' '.join(caesura_names(a[2]))
+                                 for a in analyses)
+        line_node.set('caesurae', caesurae_s)
+
     # add caesura
     caesurae = set(tuple(a[1]) for a in analyses)
     if len(caesurae) != 1:
@@ -492,7 +859,12 @@ def process_line_stream(inf, stats):
     for line in inf:
         stats['total_lines'] += 1
         line = line.strip() # strip whitespace
-        analyses = analyze_line(line)
+        try:
+            analyses = analyze_line(line, stats=stats)
+        except hexameter.BudgetExceeded as e:
+            stats['aborted'] += 1
+            print('ERROR: Aborted scan (%s): %s' % (e, line))
+            continue
         if not analyses:
             stats['no_match'] += 1
             print('ERROR: Failed to scan: ' + line)
@@ -504,28 +876,88 @@ def process_line_stream(inf, stats):
             stats['scanned'] += 1
             print(analyses[0][0])
 
+def new_stats():
+    return {
+        'total_lines': 0,
+        'scanned': 0,
+        'no_match': 0,
+        'multi_match': 0,
+        'aborted': 0,
+        'lexicon_decided': 0,
+    }
+
 def report_stats(stats):
     print('Total lines scanned: %d' % (stats['total_lines'],))
     print('Success:             %s (%.1f%%)' % (stats['scanned'], stats_pct(stats, 'scanned')))
     print('Failed:              %s (%.1f%%)' % (stats['no_match'], stats_pct(stats, 'no_match')))
     print('Multiple matches:    %s (%.1f%%)' % (stats['multi_match'], stats_pct(stats, 'multi_match')))
+    if stats['aborted']:
+        print('Aborted:             %s (%.1f%%)' % (stats['aborted'], stats_pct(stats, 'aborted')))
+    if _lexicon is not None or stats.get('lexicon_decided'):
+        print('Lexicon quantities:  %d' % (stats.get('lexicon_decided', 0),))
+    if hexameter._shadow is not None:
+        print('Shadow checks:       %d (%d diverged)' %
+              (hexameter._shadow.checked, hexameter._shadow.diverged))
 
 def stats_pct(stats, field):
     percent = float(stats[field]) / float(stats['total_lines'])
     return percent * 100
 
 if __name__ == '__main__':
+    import argparse
     import sys
-    args = sys.argv[1:]
-    stats = {
-        'total_lines': 0,
-        'scanned': 0,
-        'no_match': 0,
-        'multi_match': 0,
-    }
-    if args:
-        for fname in args:
-            process_tei_file(fname, stats)
+    parser = argparse.ArgumentParser(
+        description='Scan lines of epic hexameter from TEI files, or from '
+                    'standard input if no files are given.')
+    parser.add_argument('fnames', metavar='file.xml', nargs='*')
+    parser.add_argument('--corpus', metavar='FILE',
+                        help='also write scanned lines to a columnar '
+                             'corpus file (see corpus_store.py)')
+    parser.add_argument('--lexicon', metavar='FILE',
+                        help='consult a vowel quantity lexicon built by '
+                             'lexicon.py')
+    parser.add_argument('--works', metavar='FILE',
+                        help='JSON manifest of works to recognize besides '
+                             'the Iliad and Odyssey (see bulk_scan.py)')
+    parser.add_argument('--engine', default=hexameter.REFERENCE_ENGINE,
+                        choices=hexameter.engine_names(),
+                        help='scansion engine (default %s)' %
+                             (hexameter.REFERENCE_ENGINE,))
+    parser.add_argument('--shadow-sample', type=float, default=0.0,
+                        metavar='FRACTION',
+                        help='cross-check this fraction of lines against '
+                             'the reference engine')
+    parser.add_argument('--max-frontier', type=int, metavar='N',
+                        help='abort a line if more than N scansion paths '
+                             'are open at once')
+    parser.add_argument('--max-states', type=int, metavar='N',
+                        help='abort a line after expanding N states')
+    parser.add_argument('--max-seconds', type=float, metavar='SECONDS',
+                        help='abort a line after SECONDS of scanning')
+    args = parser.parse_args()
+    hexameter.set_engine(args.engine, args.shadow_sample)
+    if args.works:
+        try:
+            tei.set_works(tei.load_works(args.works))
+        except ValueError as e:
+            parser.error(str(e))
+    if (args.max_frontier is not None or args.max_states is not None or
+            args.max_seconds is not None):
+        set_budget(hexameter.WorkBudget(args.max_frontier, args.max_states,
+                                        args.max_seconds))
+    stats = new_stats()
+    if args.lexicon:
+        from lexicon import QuantityLexicon
+        set_lexicon(QuantityLexicon.load(args.lexicon))
+    corpus = None
+    if args.corpus:
+        from corpus_store import CorpusWriter
+        corpus = CorpusWriter()
+    if args.fnames:
+        for fname in args.fnames:
+            process_tei_file(fname, stats, corpus)
+        if corpus is not None:
+            corpus.write(args.corpus)
     else:
         process_line_stream(sys.stdin, stats)
     report_stats(stats)
@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+
+'''Serve hexameter scansion and Beta Code conversion over HTTP/JSON.
+
+Endpoints (all responses are JSON):
+
+  POST /scan             {"line": "..."}
+  POST /scan/batch       {"lines": ["...", ...]}
+  POST /betacode         {"betacode": "..."}
+  POST /betacode/batch   {"betacode": ["...", ...]}
+  GET  /metrics
+'''
+
+import asyncio
+import json
+import math
+import os
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor
+
+from betacode import betacode_to_unicode
+import hexameter
+import scan
+
+# lines whose analyses are kept between requests
+CACHE_SIZE = 100000
+# recent request latencies kept per endpoint for percentiles
+LATENCY_WINDOW = 1000
+# largest request body accepted, in bytes
+MAX_BODY = 16 * 1024 * 1024
+# longest a worker may spend scanning one line before giving up on it
+LINE_SECONDS = 5.0
+
+_REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+
+###
+### worker functions. these run in the process pool.
+###
+
+def _init_worker(line_seconds, frontier_states):
+    scan.set_budget(hexameter.WorkBudget(max_seconds=line_seconds))
+    # lines arriving over time share openings with lines already scanned
+    hexameter.set_frontier_cache(frontier_states)
+    hexameter.set_engine('cached')
+
+def _analyze_lines(lines):
+    return [_analyze_line(line) for line in lines]
+
+def _analyze_line(line):
+    try:
+        return _analysis_record(line, scan.analyze_line(line))
+    except hexameter.BudgetExceeded:
+        return _analysis_record(line, [], aborted=True)
+
+def _analysis_record(line, analyses, aborted=False):
+    record = {
+        'line': line,
+        'analyses': [{'scansion': scansion, 'line_parts': list(parts)}
+                     for scansion, parts in analyses],
+    }
+    if aborted:
+        record['aborted'] = True
+    return record
+
+###
+### caching and metrics
+###
+
+class LRUCache:
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.requests = defaultdict(int)
+        self.errors = defaultdict(int)
+        self.items = defaultdict(int)
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_WINDOW))
+
+    def record(self, endpoint, seconds, items=0, error=False):
+        self.requests[endpoint] += 1
+        self.items[endpoint] += items
+        self.latencies[endpoint].append(seconds)
+        if error:
+            self.errors[endpoint] += 1
+
+    def report(self, cache):
+        uptime = time.time() - self.started
+        endpoints = {}
+        for endpoint, count in self.requests.items():
+            recent = sorted(self.latencies[endpoint])
+            endpoints[endpoint] = {
+                'requests': count,
+                'errors': self.errors[endpoint],
+                'items': self.items[endpoint],
+                'items_per_second': self.items[endpoint] / uptime,
+                'latency_ms': {
+                    'mean': 1000 * sum(recent) / len(recent),
+                    'p50': 1000 * _percentile(recent, 0.50),
+                    'p99': 1000 * _percentile(recent, 0.99),
+                    'max': 1000 * recent[-1],
+                },
+            }
+        return {
+            'uptime_seconds': uptime,
+            'endpoints': endpoints,
+            'cache': {
+                'size': len(cache.entries),
+                'hits': cache.hits,
+                'misses': cache.misses,
+            },
+        }
+
+def _percentile(sorted_values, fraction):
+    # nearest rank: the smallest value at least fraction of the samples
+    # don't exceed
+    idx = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[idx]
+
+###
+### request handling
+###
+
+class ScansionService:
+    def __init__(self, workers=None, cache_size=CACHE_SIZE,
+                 line_seconds=LINE_SECONDS,
+                 frontier_states=hexameter.FRONTIER_CACHE_STATES):
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ProcessPoolExecutor(max_workers=self.workers,
+                                        initializer=_init_worker,
+                                        initargs=(line_seconds,
+                                                  frontier_states))
+        self.cache = LRUCache(cache_size)
+        self.metrics = Metrics()
+        self.routes = {
+            ('POST', '/scan'): self.scan,
+            ('POST', '/scan/batch'): self.scan_batch,
+            ('POST', '/betacode'): self.betacode,
+            ('POST', '/betacode/batch'): self.betacode_batch,
+            ('GET', '/metrics'): self.report_metrics,
+        }
+
+    def close(self):
+        self.pool.shutdown()
+
+    async def analyze(self, lines):
+        '''Analyze lines, answering from the cache where possible and
+        spreading the rest across the worker pool.'''
+        results = [self.cache.get(line) for line in lines]
+        missing = sorted(set(line for line, result in zip(lines, results)
+                             if result is None))
+        if missing:
+            loop = asyncio.get_running_loop()
+            chunk_size = -(-len(missing) // self.workers) # ceiling division
+            chunks = [missing[i:i+chunk_size]
+                      for i in range(0, len(missing), chunk_size)]
+            futures = [loop.run_in_executor(self.pool, _analyze_lines, chunk)
+                       for chunk in chunks]
+            analyzed = {}
+            for chunk_records in await asyncio.gather(*futures):
+                for record in chunk_records:
+                    analyzed[record['line']] = record
+                    # an aborted scan may succeed when the server is less
+                    # busy, so don't remember it.
+                    if not record.get('aborted'):
+                        self.cache.put(record['line'], record)
+            results = [result if result is not None else analyzed[line]
+                       for line, result in zip(lines, results)]
+        return results
+
+    async def scan(self, body):
+        line = _require(body, 'line', str)
+        return (await self.analyze([line]))[0], 1
+
+    async def scan_batch(self, body):
+        lines = _require_list(body, 'lines')
+        return {'results': await self.analyze(lines)}, len(lines)
+
+    async def betacode(self, body):
+        betacode = _require(body, 'betacode', str)
+        return {'unicode': betacode_to_unicode(betacode)}, 1
+
+    async def betacode_batch(self, body):
+        betacode = _require_list(body, 'betacode')
+        return {'unicode': [betacode_to_unicode(b) for b in betacode]}, \
+               len(betacode)
+
+    async def report_metrics(self, body):
+        return self.metrics.report(self.cache), 0
+
+    async def dispatch(self, method, path, body_s):
+        started = time.time()
+        items = 0
+        status = 200
+        endpoint = path
+        try:
+            handler = self.routes.get((method, path))
+            if handler is None:
+                endpoint = '(unknown)'
+                if any(p == path for m, p in self.routes):
+                    raise HTTPError(405, 'method not allowed')
+                raise HTTPError(404, 'no such endpoint')
+            body = None
+            if method == 'POST':
+                try:
+                    body = json.loads(body_s.decode('utf-8'))
+                except ValueError:
+                    raise HTTPError(400, 'request body is not valid JSON')
+                if not isinstance(body, dict):
+                    raise HTTPError(400, 'request body must be an object')
+            response, items = await handler(body)
+        except HTTPError as e:
+            status = e.status
+            response = {'error': str(e)}
+        except Exception as e:
+            status = 500
+            response = {'error': str(e)}
+        self.metrics.record(endpoint, time.time() - started, items,
+                            error=(status != 200))
+        return status, response
+
+def _require(body, key, value_type):
+    value = body.get(key)
+    if not isinstance(value, value_type):
+        raise HTTPError(400, 'expected %s in "%s"' %
+                        (value_type.__name__, key))
+    return value
+
+def _require_list(body, key):
+    values = _require(body, key, list)
+    if not all(isinstance(v, str) for v in values):
+        raise HTTPError(400, 'expected a list of strings in "%s"' % (key,))
+    return values
+
+###
+### minimal HTTP/1.1 server
+###
+
+async def _read_request(reader):
+    '''Read one request. Returns (method, path, headers, body), or None if
+    the client closed the connection.'''
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    try:
+        method, path, version = request_line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, 'malformed request line')
+
+    headers = {}
+    while True:
+        header_line = await reader.readline()
+        if header_line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = header_line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', 0) or 0)
+    except ValueError:
+        raise HTTPError(400, 'malformed content-length')
+    if length < 0:
+        raise HTTPError(400, 'malformed content-length')
+    if length > MAX_BODY:
+        raise HTTPError(413, 'request body too large')
+    body = await reader.readexactly(length) if length else b''
+    headers[':version'] = version
+    return method, path.split('?')[0], headers, body
+
+def _keep_alive(headers):
+    connection = headers.get('connection', '').lower()
+    if headers.get(':version') == 'HTTP/1.0':
+        return connection == 'keep-alive'
+    return connection != 'close'
+
+async def _write_response(writer, status, response, keep_alive):
+    body = json.dumps(response, ensure_ascii=False).encode('utf-8')
+    head = ('HTTP/1.1 %d %s\r\n'
+            'Content-Type: application/json; charset=utf-8\r\n'
+            'Content-Length: %d\r\n'
+            'Connection: %s\r\n'
+            '\r\n' % (status, _REASONS.get(status, ''), len(body),
+                      'keep-alive' if keep_alive else 'close'))
+    writer.write(head.encode('latin-1') + body)
+    await writer.drain()
+
+def make_handler(service):
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except HTTPError as e:
+                    await _write_response(writer, e.status,
+                                          {'error': str(e)}, False)
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status, response = await service.dispatch(method, path, body)
+                keep_alive = _keep_alive(headers)
+                await _write_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    return handle_connection
+
+async def serve(host, port, service):
+    server = await asyncio.start_server(make_handler(service), host, port)
+    print('Serving scansion on %s' % (', '.join(
+        '%s:%d' % s.getsockname()[:2] for s in server.sockets),))
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='scansion worker processes (default: one per '
+                             'CPU)')
+    parser.add_argument('--cache-size', type=int, default=CACHE_SIZE,
+                        help='lines to keep analyses for (default %d)'
+                             % (CACHE_SIZE,))
+    parser.add_argument('--line-seconds', type=float, default=LINE_SECONDS,
+                        help='abandon scanning a line after this long '
+                             '(default %.0f)' % (LINE_SECONDS,))
+    parser.add_argument('--frontier-states', type=int,
+                        default=hexameter.FRONTIER_CACHE_STATES,
+                        help='path states each worker keeps in its scanner '
+                             'frontier cache (default %d)'
+                             % (hexameter.FRONTIER_CACHE_STATES,))
+    args = parser.parse_args()
+
+    service = ScansionService(args.workers, args.cache_size,
+                              args.line_seconds, args.frontier_states)
+    try:
+        asyncio.run(serve(args.host, args.port, service))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.close()
@@ -0,0 +1,192 @@
+'''Read lines of hexameter from Perseus-style TEI files.
+
+:class:`TEIReader` parses a TEI file incrementally and yields one
+:class:`LineRecord` per ``<l>`` element, tracking work, book and line
+number along the way. Unless asked to keep the tree, it discards each line
+element once the caller moves on to the next, so memory stays bounded no
+matter how large the file.
+
+Works are identified from the title in the TEI header by a table of
+:class:`Work` entries. By default it knows the Iliad and the Odyssey;
+:func:`load_works` reads a manifest of others to add with
+:func:`set_works`.
+'''
+
+import json
+from collections import namedtuple
+from xml.etree import ElementTree
+
+_LineRecord = namedtuple('LineRecord', [
+    'work_name',
+    'work_abbrev',
+    'book_num',
+    'line_num',
+    'text',
+    'scansions',
+    'line_parts',
+    'caesurae',
+    'node',
+])
+
+class LineRecord(_LineRecord):
+    '''A single line of verse.
+
+    :ivar text: full text of the line
+    :ivar scansions: list of scansions from the line's ``real`` attribute,
+        empty if it hasn't been scanned
+    :ivar line_parts: tuple of the text before and after the ``<caesura>``
+        element, or None if the line has none
+    :ivar caesurae: for each scansion, a list of the names of every caesura
+        and diaeresis in it (see :func:`scan.caesura_names`), from the
+        line's ``caesurae`` attribute, or None if that wasn't recorded
+    :ivar node: the ``<l>`` element. Unless the reader keeps the tree, it
+        is only valid until the next record is read.
+    '''
+    __slots__ = ()
+
+    @property
+    def lineid(self):
+        return '%s.%s.%d' % (self.work_abbrev, self.book_num, self.line_num)
+
+_Work = namedtuple('Work', ['title', 'name', 'abbrev', 'division'])
+
+class Work(_Work):
+    '''A work that may appear in a TEI file.
+
+    :ivar title: text identifying the work in the TEI header's title
+    :ivar name: full name of the work, e.g. ``Iliad``
+    :ivar abbrev: abbreviation used in line ids, e.g. ``Il``
+    :ivar division: ``type`` of the ``<div1>`` elements dividing the work
+        into books (compared without case), or None if the work is
+        undivided, in which case all its lines are in book 1
+    '''
+    __slots__ = ()
+
+DEFAULT_WORKS = [
+    Work('Iliad', 'Iliad', 'Il', 'Book'),
+    Work('Odyssey', 'Odyssey', 'Od', 'Book'),
+]
+_works = DEFAULT_WORKS
+
+def load_works(fname):
+    '''Read a manifest of works: a JSON list of objects with ``name`` and
+    ``abbrev``, and optionally ``title`` (default: the name) and
+    ``division`` (default ``Book``).
+
+    :raises ValueError: if an abbreviation contains a dot, which would
+        make line ids ambiguous
+    '''
+    with open(fname) as inf:
+        entries = json.load(inf)
+    works = []
+    for e in entries:
+        if '.' in e['abbrev']:
+            raise ValueError('%s: abbreviation %r of %s may not contain '
+                             'a dot' % (fname, e['abbrev'], e['name']))
+        works.append(Work(e.get('title', e['name']), e['name'],
+                          e['abbrev'], e.get('division', 'Book')))
+    return works
+
+def set_works(works):
+    '''Identify works from a list of :class:`Work` entries in addition to
+    DEFAULT_WORKS, or from DEFAULT_WORKS alone if works is None. Entries
+    in works are tried first, so they may override the defaults.'''
+    global _works
+    _works = list(works or []) + DEFAULT_WORKS
+
+def identify_work(tei):
+    '''Find the :class:`Work` whose title appears in a TEI header, or None
+    if none does.'''
+    title_node = tei.find('teiHeader/fileDesc/titleStmt/title')
+    title = title_node.text if title_node is not None else None
+    if not title:
+        return None
+    for work in _works:
+        if work.title in title:
+            return work
+    return None
+
+class TEIReader:
+    '''Iterate over the lines of a TEI file.
+
+    :param keep: if true, keep the whole tree in memory so the caller may
+        modify line elements and serialize :attr:`root` afterward
+    :param require_work: if true, raise ValueError on reaching the first
+        line if the file's title matches no known work
+    '''
+    def __init__(self, fname, keep=False, require_work=False):
+        self.fname = fname
+        self.keep = keep
+        self.require_work = require_work
+        self.root = None
+        self.work_name = None
+        self.work_abbrev = None
+        self.division = 'Book'
+
+    def __iter__(self):
+        book_num = None
+        line_num = 0
+        in_text = False
+        parents = []
+        for event, node in ElementTree.iterparse(self.fname,
+                                                 events=('start', 'end')):
+            if event == 'start':
+                if self.root is None:
+                    self.root = node
+                if node.tag == 'text':
+                    in_text = True
+                    if self.division is None:
+                        book_num = '1'
+                elif in_text and node.tag == 'div1' and \
+                        self.division is not None and \
+                        node.get('type', '').lower() == self.division.lower():
+                    book_num = node.get('n')
+                    line_num = 0
+                parents.append(node)
+                continue
+
+            parents.pop()
+            if node.tag == 'teiHeader':
+                work = identify_work(self.root)
+                if work:
+                    self.work_name = work.name
+                    self.work_abbrev = work.abbrev
+                    self.division = work.division
+            elif node.tag == 'l' and in_text:
+                if self.require_work and self.work_abbrev is None:
+                    raise ValueError('no work in the manifest matches the '
+                                     'title of %s' % (self.fname,))
+                if node.get('n'):
+                    line_num = int(node.get('n'))
+                else:
+                    line_num += 1
+                yield self._record(node, book_num, line_num)
+                if not self.keep and parents:
+                    parents[-1].remove(node)
+            elif node.tag == 'text':
+                in_text = False
+
+    def _record(self, node, book_num, line_num):
+        text = ''.join(node.itertext())
+        scansion_val = node.get('real')
+        scansions = scansion_val.split(' OR ') if scansion_val else []
+        caesurae_val = node.get('caesurae')
+        caesurae = None
+        if caesurae_val is not None:
+            caesurae = [c.split() for c in caesurae_val.split(' OR ')]
+        caesura_node = node.find('caesura')
+        if caesura_node is not None:
+            after = caesura_node.tail or ''
+            line_parts = (text[:len(text) - len(after)], after)
+        else:
+            line_parts = None
+        return LineRecord(self.work_name, self.work_abbrev, book_num,
+                          line_num, text, scansions, line_parts, caesurae,
+                          node)
+
+def iter_lines(fname, require_work=False):
+    '''Generate a :class:`LineRecord` for each line in a TEI file.
+
+    :param require_work: as for :class:`TEIReader`
+    '''
+    return iter(TEIReader(fname, require_work=require_work))